@@ -1,74 +1,159 @@
+import os
+import zlib
+
+import numpy as np
+
+# crc32 of g^0, g^1, ..., g^254 for g = 2 and the polynomial 0x11d, checks a cached table
+_EXP_TABLE_CRC32 = 0x4d05cadb
+
 
 class Galoisfield256:
-    def __init__(self):
+    def __init__(self, table_file=None):
         # Irreducible polynomial for GF(2^8), represented as 0x11d
         self.irreducible_poly = 0x11d
-        # Lookup tables for multiplication and power operations
-        self.multi_dict = []
-        self.power_dict = []
-         # Precomputing multiplication table for GF(256)
-        for i in range(256):
-            temp = []
-            for j in range(256):
-                res = 0
-                a=i
-                b=j
-                # Multiply a and b using bitwise operations, following GF(2^8) rules
-                while(b > 0):
-                    if b & 1:
-                        res = res ^ a
-                    a = a<<1
-                    if a & 0x100:
-                        a ^= self.irreducible_poly
-                    b = b>>1
-                temp.append(res)
-            self.multi_dict.append(temp)
-        # Precomputing power table for GF(256)
-        for i in range(256):
-            temp = []
-            for j in range(256):
-                a = i
-                pow = j
-                res = 1
-                while pow>0:
-                    if pow%2 ==1:
-                        res = self.multi_dict[a][res]
-                    a = self.multi_dict[a][a]
-                    pow //= 2
-                temp.append(res)
-            self.power_dict.append(temp)
-        
+        # Lookup tables for exponent and logarithm of the generator g = 2
+        # exp_table is doubled (510 entries) so that exp[log a + log b] never wraps
+        self.exp_table = None
+        self.log_table = None
+        # Full multiplication and power tables, derived lazily from exp / log
+        self._multi_table = None
+        self._power_table = None
+        # the same tables as lists of lists, built on the first access
+        self._multi_dict = None
+        self._power_dict = None
+        if table_file is None or not os.path.isfile(table_file) or not self._load_exp_table(table_file):
+            # no cached table, or a stale / damaged one, build it again
+            self._init_exp_table()
+            if table_file is not None:
+                self._save_exp_table(table_file)
+        self._init_log_table()
+        # plain lists for scalar operations, indexing them is faster than numpy
+        self._exp = self.exp_table.tolist()
+        self._log = self.log_table.tolist()
+
+    def _init_exp_table(self):
+        exp = bytearray(255)
+        a = 1
+        # g^i for i in [0, 255), multiplying by g = 2 is a shift and a reduction
+        for i in range(255):
+            exp[i] = a
+            a = a << 1
+            if a & 0x100:
+                a ^= self.irreducible_poly
+        self.exp_table = np.frombuffer(exp * 2, dtype=np.uint8)
+
+    def _init_log_table(self):
+        log = np.zeros(256, dtype=np.int64)
+        log[self.exp_table[:255]] = np.arange(255)
+        self.log_table = log
+
+    # return False if the cached table is not the one of this field
+    def _load_exp_table(self, table_file):
+        # the cached file holds the 255 bytes of g^0, g^1, ..., g^254
+        with open(table_file, 'rb') as f:
+            exp = f.read()
+        # cheaper than building the table again
+        if len(exp) != 255 or zlib.crc32(exp) != _EXP_TABLE_CRC32 or len(set(exp)) != 255 or 0 in exp:
+            return False
+        self.exp_table = np.frombuffer(exp * 2, dtype=np.uint8)
+        return True
+
+    def _save_exp_table(self, table_file):
+        with open(table_file, 'wb') as f:
+            f.write(self.exp_table[:255].tobytes())
+
+    # 256 x 256 multiplication table as an array
+    @property
+    def multi_table(self):
+        if self._multi_table is None:
+            log = self.log_table
+            table = self.exp_table[log[:, None] + log[None, :]]
+            # 0 times anything is 0
+            table[0, :] = 0
+            table[:, 0] = 0
+            self._multi_table = table
+        return self._multi_table
+
+    # 256 x 256 power table as an array
+    @property
+    def power_table(self):
+        if self._power_table is None:
+            pows = np.arange(256)
+            table = self.exp_table[(self.log_table[:, None] * pows[None, :]) % 255]
+            table[0, :] = 0
+            table[0, 0] = 1
+            self._power_table = table
+        return self._power_table
+
+    # kept for compatibility: tables as lists of lists
+    @property
+    def multi_dict(self):
+        if self._multi_dict is None:
+            self._multi_dict = self.multi_table.tolist()
+        return self._multi_dict
+
+    @property
+    def power_dict(self):
+        if self._power_dict is None:
+            self._power_dict = self.power_table.tolist()
+        return self._power_dict
+
     def add(self, a, b):
         return a ^ b
-    
+
     def sub(self, a, b):
         return a ^ b
-    
+
     def multiply(self, a, b):
-        return self.multi_dict[a][b]
+        if a == 0 or b == 0:
+            return 0
+        return self._exp[self._log[a] + self._log[b]]
 
     def div(self, a, b):
-        return self.multi_dict[a][self.inverse(b)]
-    
+        return self.multiply(a, self.inverse(b))
+
     def power(self, a, pow):
         if pow<0:
             raise ValueError("We do not support negative power. Please use .inverse() instead.")
         elif a == 0:
             return 0
         else:
-            return self.power_dict[a][pow]
-        
+            return self._exp[(self._log[a] * pow) % 255]
+
     def inverse(self, a):
         if a == 0:
             raise ValueError("0 does not have inverse!")
         return self.power(a,254)
 
+    def exp(self, i):
+        return self._exp[i % 255]
+
     def log(self,a):
 
         if a == 0:
             raise ValueError("the definition field of log does not cover 0!")
-        for i in range(256):
-            if self.power_dict[2][i] == a:
-                return i
+        return self._log[a]
+
+    # vectorized operations over arrays of field elements
+    def exp_array(self, i):
+        return self.exp_table[np.asarray(i) % 255]
 
+    def log_array(self, a):
+        a = np.asarray(a, dtype=np.uint8)
+        if np.any(a == 0):
+            raise ValueError("the definition field of log does not cover 0!")
+        return self.log_table[a]
 
+    def multiply_array(self, a, b):
+        a = np.asarray(a, dtype=np.uint8)
+        b = np.asarray(b, dtype=np.uint8)
+        res = self.exp_table[self.log_table[a] + self.log_table[b]]
+        return np.where((a == 0) | (b == 0), 0, res).astype(np.uint8)
+
+    def div_array(self, a, b):
+        a = np.asarray(a, dtype=np.uint8)
+        b = np.asarray(b, dtype=np.uint8)
+        if np.any(b == 0):
+            raise ValueError("0 does not have inverse!")
+        res = self.exp_table[(self.log_table[a] - self.log_table[b]) % 255]
+        return np.where(a == 0, 0, res).astype(np.uint8)
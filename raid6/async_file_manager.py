@@ -0,0 +1,208 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _FileLock:
+
+    """
+    readers-writer lock of a file for asyncio tasks
+    many readers, or one writer at a time
+    """
+
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._readers = 0
+        self._writer = False
+        self.users = 0  # tasks holding or waiting for the lock
+
+
+    async def acquire_read(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._writer)
+            self._readers += 1
+
+
+    async def release_read(self):
+        async with self._cond:
+            self._readers -= 1
+            self._cond.notify_all()
+
+
+    async def acquire_write(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._writer and self._readers == 0)
+            self._writer = True
+
+
+    async def release_write(self):
+        async with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class AsyncFileManager:
+
+    """
+    asyncio front end of a FileManager
+
+    every disk has its own I/O queue (a single thread), blocks of read_file are read
+    through the queue of their disk, so a slow disk only holds up its own queue
+    operations changing the file system run on worker threads, one at a time (FileManager lock)
+    operations on the same file are ordered by a readers-writer lock of the file
+    """
+
+    def __init__(self,
+                 file_manager,
+                 workers=4,
+                 ):
+        self.file_manager = file_manager
+        self._disk_queues = [ThreadPoolExecutor(max_workers=1) for _ in range(file_manager.disk_num)]
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._file_locks = {}
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # waiting for the queues must not block the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+    def close(self):
+        for q in self._disk_queues:
+            q.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+
+    # run func while holding the lock of the FileManager
+    def _locked(self, func, *args):
+        with self.file_manager._lock:
+            return func(*args)
+
+
+    # read a block on the queue of its disk, the disk I/O does not hold the lock of the FileManager,
+    # so a slow disk does not hold up the other queues
+    # only a failed read takes the lock: a degraded read must not see a stripe half-written
+    def _queue_read_block(self, disk_idx, block_idx):
+        fm = self.file_manager
+        cache = fm._cache
+        if cache is not None:
+            block = cache.get(disk_idx, block_idx)
+            if block is not None:
+                return 0, bytearray(block)
+            token = cache.token()
+        res, data = fm.disk_manager.read_block(disk_idx, block_idx)
+        if res != 0:
+            return self._locked(fm._read_block, disk_idx, block_idx)
+        if cache is not None:
+            cache.fill(disk_idx, block_idx, data, token)
+        return res, data
+
+
+    async def _read_block(self, disk_idx, block_idx):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._disk_queues[disk_idx], self._queue_read_block, disk_idx, block_idx)
+
+
+    def _get_lock(self, file_name):
+        lock = self._file_locks.get(file_name)
+        if lock is None:
+            lock = _FileLock()
+            self._file_locks[file_name] = lock
+        lock.users += 1
+        return lock
+
+
+    def _put_lock(self, file_name, lock):
+        lock.users -= 1
+        if lock.users == 0:
+            del self._file_locks[file_name]
+
+
+    async def _read_locked(self, file_name, func, *args):
+        lock = self._get_lock(file_name)
+        try:
+            await lock.acquire_read()
+            try:
+                return await func(*args)
+            finally:
+                await lock.release_read()
+        finally:
+            self._put_lock(file_name, lock)
+
+
+    async def _write_locked(self, file_name, func, *args):
+        lock = self._get_lock(file_name)
+        try:
+            await lock.acquire_write()
+            try:
+                return await self._run(func, *args)
+            finally:
+                await lock.release_write()
+        finally:
+            self._put_lock(file_name, lock)
+
+
+    async def _read_file(self, file_name):
+        fm = self.file_manager
+        file_entry = await self._run(self._locked, fm._get_file_entry, file_name)
+        if file_entry is None:
+            return None
+        data = bytearray()
+        if file_entry['file_size'] == 0:
+            return data  # empty file
+        if file_entry['file_layout'] == 'map':
+            # every location is known, read all blocks through their queues at once
+            map_locations, locations = await self._run(self._locked, fm._get_file_locations, file_entry)
+            results = await asyncio.gather(*[self._read_block(d, b) for d, b in locations])
+            for res, block in results:
+                data.extend(fm._block_get_data(block))
+            return data
+        disk_idx, block_idx = file_entry['file_disk'], file_entry['file_block']
+        has_next = True
+        while has_next:
+            res, block = await self._read_block(disk_idx, block_idx)
+            size = fm._block_get_size(block)
+            if size == 0:
+                break
+            data.extend(fm._block_get_data(block, size))
+            # find next block
+            next_disk = fm._block_get_next_disk(block)
+            next_block = fm._block_get_next_block(block)
+            has_next = disk_idx != next_disk or block_idx != next_block
+            disk_idx, block_idx = next_disk, next_block
+        return data
+
+
+    async def read_file(self, file_name):
+        return await self._read_locked(file_name, self._read_file, file_name)
+
+
+    async def add_file(self, file_name, b_data):
+        return await self._write_locked(file_name, self.file_manager.add_file, file_name, b_data)
+
+
+    async def del_file(self, file_name):
+        return await self._write_locked(file_name, self.file_manager.del_file, file_name)
+
+
+    async def modify_file(self, file_name, begin, end, b_data):
+        return await self._write_locked(
+            file_name, self.file_manager.modify_file, file_name, begin, end, b_data)
+
+
+    async def append_file(self, file_name, b_data):
+        return await self._write_locked(file_name, self.file_manager.append_file, file_name, b_data)
+
+
+    async def list_files(self):
+        return await self._run(self.file_manager.list_files)
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+
+
+class BlockCache:
+
+    """
+    write-through LRU cache of blocks keyed by (disk_idx, block_idx)
+    blocks are kept as bytes, at most max_bytes of them
+
+    blocks read from disks are added with fill(), only if no block was written
+    since token() was taken before the read, so a slow reader never puts back
+    a block older than the one a writer has just put
+    """
+
+    def __init__(self, max_bytes, block_size):
+        self.max_blocks = max(int(max_bytes // block_size), 0)
+        self._blocks = OrderedDict()
+        self._version = 0  # changed by every write and invalidation
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def _insert(self, key, block):
+        self._blocks[key] = bytes(block)
+        self._blocks.move_to_end(key)
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+            self.evictions += 1
+
+
+    def get(self, disk_idx, block_idx):
+        key = (disk_idx, block_idx)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+
+    def token(self):
+        with self._lock:
+            return self._version
+
+
+    # add a block read from a disk
+    def fill(self, disk_idx, block_idx, block, token):
+        with self._lock:
+            if token == self._version and self.max_blocks > 0:
+                self._insert((disk_idx, block_idx), block)
+
+
+    # add a block written to a disk
+    def put(self, disk_idx, block_idx, block):
+        with self._lock:
+            self._version += 1
+            if self.max_blocks > 0:
+                self._insert((disk_idx, block_idx), block)
+
+
+    def invalidate(self, disk_idx, block_idx):
+        with self._lock:
+            self._version += 1
+            self._blocks.pop((disk_idx, block_idx), None)
+
+
+    def invalidate_disk(self, disk_idx):
+        with self._lock:
+            self._version += 1
+            for key in [k for k in self._blocks if k[0] == disk_idx]:
+                del self._blocks[key]
+
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._blocks.clear()
+
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'blocks': len(self._blocks),
+                'max_blocks': self.max_blocks,
+            }
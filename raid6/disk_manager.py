@@ -1,5 +1,10 @@
+import mmap
 import os
 import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 class DiskManager:
@@ -8,11 +13,16 @@ class DiskManager:
                  disk_size,
                  block_size,
                  disks=None,
+                 health_check_interval=None,
+                 io_workers=None,
+                 write_back_size=None,
+                 write_back_interval=None,
                  ):
         self.disk_size = disk_size
         self.block_size = block_size
         self.block_num = int(disk_size // block_size)
-        # f: folder
+        # f: folder, a file for every block
+        # img: a preallocated image file for every disk, blocks are accessed through mmap
         if disks is None:
             self.disks = [
                 ('f', './disks/'),
@@ -25,28 +35,183 @@ class DiskManager:
         else:
             self.disks = disks
         self.disk_num = len(disks)
+        # opened images: {disk_idx: (file, mmap)}
+        self._images = {}
+        self._images_lock = threading.RLock()
+        # disk health, kept in memory and updated from I/O errors and health checks
+        # _failed_disks: disks not accessible
+        # _bad_blocks: a bitmap of missing blocks for every disk
+        # _stripe_bad: number of missing blocks in every stripe
+        self._failed_disks = set()
+        self._bad_blocks = [bytearray(self.block_num) for _ in range(self.disk_num)]
+        self._stripe_bad = [0] * self.block_num
+        self._health_lock = threading.Lock()
+        # seconds between two health checks started by writes, None: only check on errors
+        self.health_check_interval = health_check_interval
+        self._last_health_check = 0
+        self.check_health()
+        # threads for batched I/O, requests to different disks are overlapped
+        # by default one per disk, but not many more than the CPUs can drive
+        if io_workers is None:
+            io_workers = min(self.disk_num, (os.cpu_count() or 1) * 4)
+        self.io_workers = io_workers
+        self._io_executor = None
+        self._io_executor_lock = threading.Lock()
+        # write-back: writes are kept in memory and flushed together
+        # write_back_size: bytes of dirty blocks that start a flush, None: write every block at once
+        # write_back_interval: seconds a dirty block waits at most, None: no time limit
+        self.write_back_size = write_back_size
+        self.write_back_interval = write_back_interval
+        self._dirty = OrderedDict()  # (disk_idx, block_idx) -> block, oldest first
+        self._dirty_since = None  # time of the oldest dirty block
+        self._dirty_lock = threading.RLock()
+        self._flush_thread = None
+        # blocks of folder disks written since the last sync
+        self._unsynced = [set() for _ in range(self.disk_num)]
 
 
-    # if a block is accessible
-    def check_block(self, disk_idx, block_idx):
+    def _set_block_bad(self, disk_idx, block_idx, bad):
+        if self._bad_blocks[disk_idx][block_idx] == bad:
+            return
+        self._bad_blocks[disk_idx][block_idx] = bad
+        self._stripe_bad[block_idx] += 1 if bad else -1
+
+
+    # update the health of a disk: failed or not, and its missing blocks
+    def _set_disk_health(self, disk_idx, failed, missing=None):
+        with self._health_lock:
+            if failed:
+                self._failed_disks.add(disk_idx)
+                missing = range(self.block_num)
+            else:
+                self._failed_disks.discard(disk_idx)
+            bad = bytearray(self.block_num)
+            for b in missing or ():
+                bad[b] = 1
+            for b in range(self.block_num):
+                self._set_block_bad(disk_idx, b, bad[b])
+
+
+    def _mark_block(self, disk_idx, block_idx, bad):
+        if self._bad_blocks[disk_idx][block_idx] == bad:
+            return
+        with self._health_lock:
+            self._set_block_bad(disk_idx, block_idx, bad)
+
+
+    # a write succeeded: the disk is accessible and the block is valid
+    def _mark_block_written(self, disk_idx, block_idx):
+        if disk_idx in self._failed_disks:
+            with self._health_lock:
+                self._failed_disks.discard(disk_idx)
+        self._mark_block(disk_idx, block_idx, 0)
+
+
+    # probe a disk on the file system, return (failed, missing blocks)
+    def _probe_disk(self, disk_idx):
         if self.disks[disk_idx][0] == 'f':
             disk_path = os.path.join(self.disks[disk_idx][1], 'disk_{}'.format(disk_idx))
-            block_path = os.path.join(disk_path, 'block_{}'.format(block_idx))
-            if not os.path.isfile(block_path):
-                return -2
-            return 0
+            try:
+                names = set(os.listdir(disk_path))
+            except OSError:
+                return True, None
+            missing = [b for b in range(self.block_num) if 'block_{}'.format(b) not in names]
+            return False, missing
+        elif self.disks[disk_idx][0] == 'img':
+            image_path = self._image_path(disk_idx)
+            if not os.path.isfile(image_path) or os.path.getsize(image_path) < self.block_num * self.block_size:
+                self._close_image(disk_idx)
+                return True, None
+            # blocks not rebuilt yet in a recreated image stay missing
+            missing = [b for b in range(self.block_num) if self._bad_blocks[disk_idx][b]]
+            return False, missing
+
+
+    # probe every disk and refresh the cached health
+    def check_health(self):
+        for d in range(self.disk_num):
+            failed, missing = self._probe_disk(d)
+            self._set_disk_health(d, failed, missing)
+        self._last_health_check = time.time()
+        return self.check_array()
+
+
+    # -1: a disk failed, -2: some blocks are missing, 0: healthy
+    def check_array(self):
+        if len(self._failed_disks) > 0:
+            return -1
+        if any(self._stripe_bad):
+            return -2
+        return 0
+
+
+    def _image_path(self, disk_idx):
+        return os.path.join(self.disks[disk_idx][1], 'disk_{}.img'.format(disk_idx))
+
+
+    # mmap of an image, None if the image is not accessible
+    # an open mmap keeps an image removed outside the manager alive, so the removal is
+    # only noticed by check_health (or health_check_interval), which probes the path
+    def _open_image(self, disk_idx):
+        image = self._images.get(disk_idx)
+        if image is not None:
+            return image[1]
+        with self._images_lock:
+            image = self._images.get(disk_idx)
+            if image is not None:
+                return image[1]
+            image_path = self._image_path(disk_idx)
+            if not os.path.isfile(image_path):
+                return None
+            f = open(image_path, 'r+b')
+            if os.fstat(f.fileno()).st_size < self.block_num * self.block_size:
+                f.close()
+                return None
+            mm = mmap.mmap(f.fileno(), self.block_num * self.block_size)
+            self._images[disk_idx] = (f, mm)
+            return mm
+
+
+    def _close_image(self, disk_idx):
+        with self._images_lock:
+            image = self._images.pop(disk_idx, None)
+        if image is None:
+            return
+        f, mm = image
+        try:
+            mm.close()
+        except BufferError:
+            pass  # views of blocks are still in use, the mapping is released with them
+        f.close()
+
+
+    # create a zero-filled image with a single truncate
+    # missing: blocks are not valid until written (an image recreated in recovery)
+    def _create_image(self, disk_idx, missing=False):
+        self._close_image(disk_idx)
+        os.makedirs(self.disks[disk_idx][1], exist_ok=True)
+        with open(self._image_path(disk_idx), 'wb') as f:
+            f.truncate(self.block_num * self.block_size)
+        self._set_disk_health(disk_idx, False, range(self.block_num) if missing else None)
+
+
+    # if a block is accessible
+    def check_block(self, disk_idx, block_idx):
+        if disk_idx in self._failed_disks or self._bad_blocks[disk_idx][block_idx]:
+            return -2
+        return 0
 
 
     # if a disk is accessible
     def check_disk(self, disk_idx):
-        if self.disks[disk_idx][0] == 'f':
-            disk_path = os.path.join(self.disks[disk_idx][1], 'disk_{}'.format(disk_idx))
-            if not os.path.isdir(disk_path):
-                return -1
-            return 0
+        if disk_idx in self._failed_disks:
+            return -1
+        return 0
 
 
     def reset_disk(self, disk_idx):
+        self._drop_dirty(disk_idx)
+        self._unsynced[disk_idx] = set()
         if self.disks[disk_idx][0] == 'f':
             # create a new disk folder
             disk_path = os.path.join(self.disks[disk_idx][1], 'disk_{}'.format(disk_idx))
@@ -58,10 +223,15 @@ class DiskManager:
                 block_path = os.path.join(disk_path, 'block_{}'.format(i))
                 with open(block_path, 'wb') as f:
                     f.write(b'\x00' * self.block_size)
+            self._set_disk_health(disk_idx, False)
+            return 0
+        elif self.disks[disk_idx][0] == 'img':
+            self._create_image(disk_idx)
             return 0
 
 
     def reset_block(self, disk_idx, block_idx):
+        self._drop_dirty(disk_idx, block_idx)
         if self.disks[disk_idx][0] == 'f':
             disk_path = os.path.join(self.disks[disk_idx][1], 'disk_{}'.format(disk_idx))
             # disk not accessible
@@ -71,69 +241,309 @@ class DiskManager:
             # reset the block to zero
             with open(block_path, 'wb') as f:
                 f.write(b'\x00' * self.block_size)
+            self._mark_block_written(disk_idx, block_idx)
+            return 0
+        elif self.disks[disk_idx][0] == 'img':
+            mm = self._open_image(disk_idx)
+            if mm is None:
+                return -1
+            offset = block_idx * self.block_size
+            mm[offset:offset+self.block_size] = b'\x00' * self.block_size
+            self._mark_block_written(disk_idx, block_idx)
             return 0
 
 
     def check_failure(self, block_idx):
-        # check every disk
-        for d in range(self.disk_num):
-            if self.disks[d][0] == 'f':
-                disk_path = os.path.join(self.disks[d][1], 'disk_{}'.format(d))
-                if not os.path.isdir(disk_path):
-                    return -1
-                # block is missing
-                block_path = os.path.join(disk_path, 'block_{}'.format(block_idx))
-                if not os.path.isfile(block_path):
-                    return -2
+        # check every disk, from the cached health
+        if len(self._failed_disks) > 0:
+            return -1
+        # block is missing
+        if self._stripe_bad[block_idx] > 0:
+            return -2
         return 0
 
 
     def write_block(self, block, disk_idx, block_idx, force=False):
         # check disk failures in every time of writing
+        if self.health_check_interval is not None and \
+                time.time() - self._last_health_check > self.health_check_interval:
+            self.check_health()
         res = self.check_failure(block_idx)
+        if res != 0 and not force:
+            return res
+        if self.write_back_size is not None and not force:
+            return self._buffer_block(block, disk_idx, block_idx)
+        if self._dirty:
+            # written at once, the buffered block is older
+            with self._dirty_lock:
+                self._dirty.pop((disk_idx, block_idx), None)
+        return self._write_to_disk(block, disk_idx, block_idx, create=res != 0)
+
+
+    # create: create the disk if it does not exist (used in recovery)
+    def _write_to_disk(self, block, disk_idx, block_idx, create=False):
         if self.disks[disk_idx][0] == 'f':
             disk_path = os.path.join(self.disks[disk_idx][1], 'disk_{}'.format(disk_idx))
             block_path = os.path.join(disk_path, 'block_{}'.format(block_idx))
-            if res == 0:
+            if create:
+                # force to write (used in recovery)
+                # several recovery workers may create the disk at the same time
+                os.makedirs(disk_path, exist_ok=True)
+            try:
                 with open(block_path, 'wb') as file:
                     file.write(block)
+            except OSError:
+                self._set_disk_health(disk_idx, True)
+                return -1
+            self._unsynced[disk_idx].add(block_idx)
+        elif self.disks[disk_idx][0] == 'img':
+            offset = block_idx * self.block_size
+            if create:
+                # force to write (used in recovery)
+                with self._images_lock:
+                    if not os.path.isfile(self._image_path(disk_idx)):
+                        self._create_image(disk_idx, missing=True)
+            mm = self._open_image(disk_idx)
+            if mm is None:
+                self._set_disk_health(disk_idx, True)
+                return -1
+            mm[offset:offset+self.block_size] = block
+        self._mark_block_written(disk_idx, block_idx)
+        return 0
+
+
+    # keep a block in the dirty buffer, a later write of the same block replaces it
+    # return the result of the flush it starts, or 0
+    def _buffer_block(self, block, disk_idx, block_idx):
+        with self._dirty_lock:
+            self._dirty[(disk_idx, block_idx)] = bytes(block)
+            if self._dirty_since is None:
+                self._dirty_since = time.time()
+                if self.write_back_interval is not None and self._flush_thread is None:
+                    self._flush_thread = threading.Thread(target=self._background_flush, daemon=True)
+                    self._flush_thread.start()
+            if len(self._dirty) * self.block_size >= self.write_back_size:
+                return self.flush()
+        return 0
+
+
+    # flush dirty blocks older than write_back_interval
+    def _background_flush(self):
+        while True:
+            with self._dirty_lock:
+                if self._dirty_since is None:
+                    self._flush_thread = None
+                    return
+                delay = self._dirty_since + self.write_back_interval - time.time()
+                if delay <= 0:
+                    self.flush()
+                    continue
+            time.sleep(delay)
+
+
+    # write every dirty block, blocks of failed disks are dropped (recovered from parity)
+    # return 0, or -1 if a disk failed while flushing
+    def flush(self):
+        with self._dirty_lock:
+            if not self._dirty:
+                self._dirty_since = None
                 return 0
-            if not force:
-                return res
-            # force to write (used in recovery)
-            if not os.path.isdir(disk_path):
-                os.makedirs(disk_path)
-            with open(block_path, 'wb') as file:
-                file.write(block)
+            blocks = [(block, d, b) for (d, b), block in self._dirty.items() if d not in self._failed_disks]
+            results = self._run_io(self._write_to_disk, blocks)
+            self._dirty.clear()
+            self._dirty_since = None
+        return 0 if all(res == 0 for res in results) else -1
+
+
+    # flush a single dirty block, return 0 or -1 if the disk failed
+    def _flush_block(self, disk_idx, block_idx):
+        with self._dirty_lock:
+            block = self._dirty.pop((disk_idx, block_idx), None)
+            if not self._dirty:
+                self._dirty_since = None
+            if block is None or disk_idx in self._failed_disks:
+                return 0
+            return self._write_to_disk(block, disk_idx, block_idx)
+
+
+    # flush the dirty blocks of a stripe only, return 0 or -1 if a disk failed
+    def flush_stripe(self, block_idx):
+        if not self._dirty:
             return 0
+        results = [self._flush_block(d, block_idx) for d in range(self.disk_num)]
+        return 0 if all(res == 0 for res in results) else -1
+
+
+    def _drop_dirty(self, disk_idx, block_idx=None):
+        with self._dirty_lock:
+            for key in [k for k in self._dirty if k[0] == disk_idx and block_idx in (None, k[1])]:
+                del self._dirty[key]
+            if not self._dirty:
+                self._dirty_since = None
+
+
+    # flush, then make everything written durable with fsync on every disk
+    def sync(self):
+        res = self.flush()
+        for d in range(self.disk_num):
+            if d in self._failed_disks:
+                continue
+            try:
+                if self.disks[d][0] == 'f':
+                    disk_path = os.path.join(self.disks[d][1], 'disk_{}'.format(d))
+                    unsynced, self._unsynced[d] = self._unsynced[d], set()
+                    for b in unsynced:
+                        fd = os.open(os.path.join(disk_path, 'block_{}'.format(b)), os.O_RDONLY)
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+                    # the folder holds the names of the block files
+                    fd = os.open(disk_path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                elif self.disks[d][0] == 'img':
+                    with self._images_lock:
+                        image = self._images.get(d)
+                        if image is not None:
+                            image[1].flush()
+                            os.fsync(image[0].fileno())
+            except OSError:
+                self._set_disk_health(d, True)
+                res = -1
+        return res
+
+
+    # a block waiting in the dirty buffer, None if it is not buffered
+    def _get_dirty(self, disk_idx, block_idx):
+        if not self._dirty:
+            return None
+        with self._dirty_lock:
+            return self._dirty.get((disk_idx, block_idx))
 
 
-    def read_block(self, disk_idx, block_idx):
+    # buffer: a preallocated bytearray to read into
+    def read_block(self, disk_idx, block_idx, buffer=None):
+        if disk_idx in self._failed_disks:
+            return -1, None  # disk failed
+        if self._bad_blocks[disk_idx][block_idx]:
+            return -2, None  # block failed
+        dirty = self._get_dirty(disk_idx, block_idx)
+        if dirty is not None:
+            if buffer is None:
+                return 0, bytearray(dirty)
+            buffer[:] = dirty
+            return 0, buffer
         if self.disks[disk_idx][0] == 'f':
             disk_path = os.path.join(self.disks[disk_idx][1], 'disk_{}'.format(disk_idx))
-            if not os.path.isdir(disk_path):
-                return -1, None  # disk failed
             block_path = os.path.join(disk_path, 'block_{}'.format(block_idx))
-            if not os.path.isfile(block_path):
+            try:
+                with open(block_path, 'rb') as file:
+                    if buffer is None:
+                        data = bytearray(file.read())
+                    else:
+                        data = buffer
+                        if file.readinto(buffer) != self.block_size:
+                            data = None
+            except OSError:
+                if not os.path.isdir(disk_path):
+                    self._set_disk_health(disk_idx, True)
+                    return -1, None  # disk failed
+                self._mark_block(disk_idx, block_idx, 1)
+                return -2, None  # block failed
+            if data is None or len(data) != self.block_size:
+                self._mark_block(disk_idx, block_idx, 1)
                 return -2, None  # block failed
-            with open(block_path, 'rb') as file:
-                data = bytearray(file.read())
-                if len(data) != self.block_size:
-                    return -2, None  # block failed
-                return 0, data
+            return 0, data
+        elif self.disks[disk_idx][0] == 'img':
+            mm = self._open_image(disk_idx)
+            if mm is None:
+                self._set_disk_health(disk_idx, True)
+                return -1, None  # disk failed
+            offset = block_idx * self.block_size
+            if buffer is None:
+                return 0, bytearray(mm[offset:offset+self.block_size])
+            buffer[:] = mm[offset:offset+self.block_size]
+            return 0, buffer
+
+
+    # read a block without copying it (read-only), only img disks are not copied
+    def read_block_view(self, disk_idx, block_idx):
+        if self.disks[disk_idx][0] == 'img':
+            if disk_idx in self._failed_disks:
+                return -1, None  # disk failed
+            if self._bad_blocks[disk_idx][block_idx]:
+                return -2, None  # block failed
+            dirty = self._get_dirty(disk_idx, block_idx)
+            if dirty is not None:
+                return 0, dirty
+            mm = self._open_image(disk_idx)
+            if mm is None:
+                self._set_disk_health(disk_idx, True)
+                return -1, None  # disk failed
+            offset = block_idx * self.block_size
+            return 0, memoryview(mm)[offset:offset+self.block_size].toreadonly()
+        return self.read_block(disk_idx, block_idx)
+
+
+    # run I/O requests [(args), ...] on the thread pool, folder disks only
+    def _run_io(self, func, requests):
+        if self.io_workers <= 1 or len(requests) <= 1 or \
+                all(self.disks[r[1]][0] != 'f' for r in requests):
+            return [func(*r) for r in requests]
+        if self._io_executor is None:
+            with self._io_executor_lock:
+                if self._io_executor is None:
+                    self._io_executor = ThreadPoolExecutor(max_workers=self.io_workers)
+        futures = [self._io_executor.submit(func, *r) for r in requests]
+        return [f.result() for f in futures]
+
+
+    # read blocks [(disk_idx, block_idx), ...] at the same time, return [(res, data), ...]
+    # buffers: preallocated bytearrays to read into, view: see read_block_view
+    def read_blocks(self, locations, buffers=None, view=False):
+        if view:
+            return self._run_io(lambda b, d, i: self.read_block_view(d, i),
+                                [(None, d, b) for d, b in locations])
+        if buffers is None:
+            buffers = [None] * len(locations)
+        return self._run_io(lambda buf, d, b: self.read_block(d, b, buf),
+                            [(buf, d, b) for (d, b), buf in zip(locations, buffers)])
+
+
+    # write blocks [(block, disk_idx, block_idx), ...] at the same time, return [res, ...]
+    def write_blocks(self, blocks, force=False):
+        if self.write_back_size is not None and not force:
+            # only buffered, no I/O to overlap
+            return [self.write_block(block, d, b) for block, d, b in blocks]
+        return self._run_io(lambda block, d, b: self.write_block(block, d, b, force=force), blocks)
 
 
     def fail_disk(self, disk_idx):
+        # buffered writes of the disk are lost with it
+        self._drop_dirty(disk_idx)
+        self._unsynced[disk_idx] = set()
         if self.disks[disk_idx][0] == 'f':
             disk_path = os.path.join(self.disks[disk_idx][1], 'disk_{}'.format(disk_idx))
             # remove the folder
             if os.path.exists(disk_path):
                 shutil.rmtree(disk_path)
+            self._set_disk_health(disk_idx, True)
+            return 0
+        elif self.disks[disk_idx][0] == 'img':
+            # remove the image
+            self._close_image(disk_idx)
+            if os.path.exists(self._image_path(disk_idx)):
+                os.remove(self._image_path(disk_idx))
+            self._set_disk_health(disk_idx, True)
             return 0
 
 
     def corrupt_block(self, disk_idx, block_idx):
         import random
+        self._flush_block(disk_idx, block_idx)
         if self.disks[disk_idx][0] == 'f':
             disk_path = os.path.join(self.disks[disk_idx][1], 'disk_{}'.format(disk_idx))
             if not os.path.isdir(disk_path):
@@ -150,6 +560,16 @@ class DiskManager:
             with open(block_path, 'wb') as f:
                 f.write(data)
             return 0
+        elif self.disks[disk_idx][0] == 'img':
+            mm = self._open_image(disk_idx)
+            if mm is None:
+                return -1
+            offset = block_idx * self.block_size
+            for i in range(offset, offset + self.block_size):
+                # randomly change some bytes in the block
+                if random.random() < 0.2:
+                    mm[i] = random.randint(0, 255)
+            return 0
 
 
 if __name__ == '__main__':
@@ -1,6 +1,12 @@
+from functools import lru_cache
+
+import numpy as np
+
 from .Galoisfield256 import Galoisfield256
 
 _mygf = Galoisfield256()
+# multiplication table as an array, used for table lookups on whole blocks
+_gf_mul = _mygf.multi_table
 
 def sum_list(D: list):
     s = 0
@@ -25,6 +31,108 @@ def compute_PQ(D: list) -> list:
 
     return [P, Q]
 
+def _PQ_arrays(data: list) -> list:
+    # data is a list of uint8 arrays of the same length
+    P = data[-1].copy()
+    Q = data[-1].copy()
+    mul_g = _gf_mul[2]
+    # Horner's rule from the last block: Q = (...(D[n-1]*g + D[n-2])*g ...) + D[0]
+    for Di in reversed(data[:-1]):
+        P ^= Di
+        Q = mul_g[Q]
+        Q ^= Di
+
+    return [P, Q]
+
+def compute_PQ_blocks(blocks: list) -> list:
+    # blocks are the data blocks of a stripe (without P & Q)
+    data = [np.frombuffer(b, dtype=np.uint8) for b in blocks]
+    P, Q = _PQ_arrays(data)
+
+    return [bytearray(P), bytearray(Q)]
+
+def update_PQ_blocks(P, Q, old, new, idx: int) -> list:
+    # only one data block (at index idx) changes: P' = P + delta, Q' = Q + g^idx * delta
+    delta = np.frombuffer(old, dtype=np.uint8) ^ np.frombuffer(new, dtype=np.uint8)
+    P = np.frombuffer(P, dtype=np.uint8) ^ delta
+    Q = np.frombuffer(Q, dtype=np.uint8) ^ _gf_mul[_mygf.power(2, idx)][delta]
+
+    return [bytearray(P), bytearray(Q)]
+
+@lru_cache(maxsize=None)
+def _failure_coefficients(x: int, y: int) -> tuple:
+    # coefficients only depend on the failed positions, see failure_fix
+    g = 2
+    if y < 0:
+        # a data and P fail: Dx = (Q + Qx) * g^(-x)
+        return _mygf.power(g, 255-x), None
+    A = _mygf.power(g, y-x)
+    B = _mygf.power(g, 255-x)
+    T = _mygf.inverse(_mygf.add(A, 1))
+    return _mygf.multiply(A, T), _mygf.multiply(B, T)
+
+def failure_fix_blocks(blocks: list, pos: list) -> list:
+    # blocks is a stripe of blocks with P & Q in the end, same cases as failure_fix
+    total = len(blocks)
+    if len(pos) > 2:
+        raise Exception('At most two disk failure at the same time can be fixed')
+    if len(pos) == 0:
+        return pos
+    if len(pos) == 2 and pos[0] >= pos[1]:
+        raise Exception('Please make sure pos[0] < pos[1]')
+    size = len(blocks[next(i for i in range(total) if i not in pos)])
+    zero = np.zeros(size, dtype=np.uint8)
+    # failed blocks are treated as zeros
+    D = [zero if i in pos else np.frombuffer(blocks[i], dtype=np.uint8) for i in range(total)]
+    data = D[:-2]
+
+    # Just one drive lost
+    if len(pos) == 1:
+        if pos[0] == total-2:
+            # disk with P fails
+            return [bytearray(_PQ_arrays(data)[0])]
+        elif pos[0] == total-1:
+            # disk with Q fails
+            return [bytearray(_PQ_arrays(data)[1])]
+        else:
+            # disk with data fails
+            Dx = D[-2].copy()
+            for Di in data:
+                Dx ^= Di
+            return [bytearray(Dx)]
+
+    # Two drives lost
+    x, y = pos
+    if x == total-2 and y == total-1:
+        # disks with P & Q fail
+        P, Q = _PQ_arrays(data)
+        return [bytearray(P), bytearray(Q)]
+
+    if y == total-2:
+        # disks with a data and P fail
+        Qx = _PQ_arrays(data)[1]
+        C, _ = _failure_coefficients(x, -1)
+        Dx = _gf_mul[C][D[-1] ^ Qx]
+        P = _PQ_arrays(data[:x] + [Dx] + data[x+1:])[0]
+        return [bytearray(Dx), bytearray(P)]
+
+    if y == total-1:
+        # disks with a data and Q fail
+        Dx = D[-2].copy()
+        for Di in data:
+            Dx ^= Di
+        Q = _PQ_arrays(data[:x] + [Dx] + data[x+1:])[1]
+        return [bytearray(Dx), bytearray(Q)]
+
+    # disks with only data fail
+    Pxy, Qxy = _PQ_arrays(data)
+    Pxy ^= D[-2]  # P + Pxy
+    Qxy ^= D[-1]  # Q + Qxy
+    A, B = _failure_coefficients(x, y)
+    Dx = _gf_mul[A][Pxy] ^ _gf_mul[B][Qxy]  # Dx = A(P+Pxy)+B(Q+Qxy)
+    Dy = Dx ^ Pxy  # Dy = Dx + P +Pxy
+    return [bytearray(Dx), bytearray(Dy)]
+
 def failure_fix(D: list, pos: list) -> list:
     # D is a row of bytes with P & Q in the end
     total = len(D)
@@ -133,6 +241,45 @@ def corruption_check_fix(D: list) -> list:
     return [z, Dz]
 
 
+def corruption_check_fix_blocks(blocks: list) -> list:
+    # blocks is a stripe of blocks with P & Q in the end, same syndromes as corruption_check_fix
+    # No error return [-1, None], If error return [pos, corrected block]
+    total = len(blocks)
+    D = [np.frombuffer(b, dtype=np.uint8) for b in blocks]
+    Px, Qx = _PQ_arrays(D[:-2])
+    P_ = D[-2] ^ Px
+    Q_ = D[-1] ^ Qx
+    mask = (P_ != 0) | (Q_ != 0)
+    if not mask.any():
+        # No error
+        return [-1, None]
+    P_, Q_ = P_[mask], Q_[mask]
+    # P_ == 0: Q drive corruption, Q_ == 0: P drive corruption
+    pos = np.full(len(P_), total-1, dtype=np.int64)
+    pos[Q_ == 0] = total-2
+    data = (P_ != 0) & (Q_ != 0)
+    if data.any():
+        # Data drive corruption, z = log(Q_) - log(P_)
+        z_data = (_mygf.log_table[Q_[data]] - _mygf.log_table[P_[data]]) % 255
+        # a data position out of the data blocks (also P or Q) means more than one block is corrupted
+        if (z_data >= total-2).any():
+            raise Exception('More than 1 block corrupted in a stripe!')
+        pos[data] = z_data
+    z = int(pos[0])
+    if not (pos == z).all():
+        raise Exception('More than 1 block corrupted in a stripe!')
+    fixed = D[z].copy()
+    if z == total-2:
+        fixed[mask] = Px[mask]
+    elif z == total-1:
+        fixed[mask] = Qx[mask]
+    else:
+        # Dz = Dz' + P_, the same as summing all other blocks with P
+        fixed[mask] ^= P_
+
+    return [z, bytearray(fixed)]
+
+
 if __name__ == '__main__':
     import random, copy
 
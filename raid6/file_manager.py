@@ -1,9 +1,227 @@
+import functools
+import heapq
+import itertools
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .fault_tolerance import failure_fix, corruption_check_fix, compute_PQ
+from .fault_tolerance import failure_fix_blocks, corruption_check_fix_blocks, compute_PQ_blocks, update_PQ_blocks
+from .block_cache import BlockCache
 from .disk_manager import DiskManager
 
 
+# run a method of FileManager while holding its lock
+def _synchronized(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class FileWriter:
+
+    """
+    streaming writer of a new file, returned by FileManager.open_for_write
+    blocks are allocated as data arrives and written one stripe at a time,
+    the table entry is added on close, so the file is not visible before
+    """
+
+    def __init__(self, file_manager, file_name, layout):
+        self.file_manager = file_manager
+        self.file_name = file_name
+        self.layout = layout
+        self.size = 0
+        self.closed = False
+        # allocation goes forward from the end of the file directory table
+        self._last_location = (file_manager._last_table_disk, file_manager._last_table_block)
+        self._reserved = 0  # allocated blocks, counted as used until close
+        # data block being filled
+        self._buffer = bytearray()
+        self._location = None
+        self._data_first = None
+        self._data_written = 0
+        # map block being filled (map layout)
+        self._map_entries = bytearray()
+        self._map_location = None
+        self._map_first = None
+        self._map_written = 0
+        # blocks of the current stripe waiting to be written
+        self._stripe_blocks = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+    def _allocate(self):
+        fm = self.file_manager
+        if fm._used_blocks + 1 > fm._max_file_blocks:
+            return None  # no enough spaces
+        location = fm._next_available_block(*self._last_location)
+        if location is None:
+            return None
+        fm._allocate_block(*location)
+        fm._used_blocks += 1
+        self._reserved += 1
+        self._last_location = location
+        return location
+
+
+    def _put_block(self, block, disk_idx, block_idx):
+        if self._stripe_blocks and self._stripe_blocks[0][2] != block_idx:
+            self._flush()
+        self._stripe_blocks.append((block, disk_idx, block_idx))
+
+
+    def _flush(self):
+        if self._stripe_blocks:
+            self.file_manager._write_data_blocks(self._stripe_blocks)
+            self._stripe_blocks = []
+
+
+    # finish the data block being filled, pointing to the next one
+    def _put_data_block(self, next_location):
+        fm = self.file_manager
+        block = bytearray()
+        block.extend(len(self._buffer).to_bytes(4, 'little'))
+        block.extend(next_location[0].to_bytes(4, 'little'))
+        block.extend(next_location[1].to_bytes(4, 'little'))
+        block.extend(self._buffer)
+        block.extend(b'\x00' * (fm.block_size - len(block)))
+        self._put_block(block, *self._location)
+        self._data_written += 1
+        self._buffer = bytearray()
+
+
+    # finish the map block being filled, pointing to the next one
+    def _put_map_block(self, next_location):
+        fm = self.file_manager
+        block = bytearray()
+        block.extend((len(self._map_entries) // fm._map_entry_size).to_bytes(4, 'little'))
+        block.extend(next_location[0].to_bytes(4, 'little'))
+        block.extend(next_location[1].to_bytes(4, 'little'))
+        block.extend(self._map_entries)
+        block.extend(b'\x00' * (fm.block_size - len(block)))
+        self._put_block(block, *self._map_location)
+        self._map_written += 1
+        self._map_entries = bytearray()
+
+
+    # allocate the next data block (and a map block when the current one is full)
+    def _new_data_block(self):
+        fm = self.file_manager
+        if self.layout == 'map' and (self._map_location is None or
+                                     len(self._map_entries) == fm._map_entry_num * fm._map_entry_size):
+            map_location = self._allocate()
+            if map_location is None:
+                return -1
+            if self._map_location is None:
+                self._map_first = map_location
+            else:
+                self._put_map_block(map_location)
+            self._map_location = map_location
+        location = self._allocate()
+        if location is None:
+            return -1
+        if self._location is None:
+            self._data_first = location
+        else:
+            self._put_data_block(location)
+        self._location = location
+        if self.layout == 'map':
+            self._map_entries.extend(location[0].to_bytes(4, 'little'))
+            self._map_entries.extend(location[1].to_bytes(4, 'little'))
+        return 0
+
+
+    def write(self, b_data):
+        fm = self.file_manager
+        b_data = memoryview(b_data)
+        with fm._lock:
+            if self.closed:
+                return -1
+            pos = 0
+            while pos < len(b_data):
+                if self._location is None or len(self._buffer) == fm.block_data_size:
+                    if self._new_data_block() != 0:
+                        self.abort()
+                        return -1
+                size = min(fm.block_data_size - len(self._buffer), len(b_data) - pos)
+                self._buffer.extend(b_data[pos:pos+size])
+                pos += size
+                self.size += size
+            return 0
+
+
+    # zero and free count blocks chained from first, and the one being filled
+    def _release_chain(self, first, count, current):
+        fm = self.file_manager
+        data = bytes(fm.block_size)
+        disk_idx, block_idx = first if count > 0 else (None, None)
+        for _ in range(count):
+            res, block = fm._read_block(disk_idx, block_idx, view=True)
+            next_disk = fm._block_get_next_disk(block)
+            next_block = fm._block_get_next_block(block)
+            fm._write_data_blocks([(data, disk_idx, block_idx)])
+            fm._free_block(disk_idx, block_idx)
+            disk_idx, block_idx = next_disk, next_block
+        if current is not None:
+            fm._free_block(*current)
+
+
+    # drop the file, every block written so far is freed
+    def abort(self):
+        fm = self.file_manager
+        with fm._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._flush()
+            self._release_chain(self._data_first, self._data_written, self._location)
+            self._release_chain(self._map_first, self._map_written, self._map_location)
+            fm._used_blocks -= self._reserved
+            fm._open_writers.discard(self.file_name)
+
+
+    def close(self):
+        fm = self.file_manager
+        with fm._lock:
+            if self.closed:
+                return -1
+            # the last blocks point to themselves
+            if self._location is not None:
+                self._put_data_block(self._location)
+            if self._map_location is not None:
+                self._put_map_block(self._map_location)
+            self._flush()
+            self._location = self._map_location = None
+            # blocks are counted by the table entry from now on
+            if self.size == 0:
+                layout, first = 'chain', fm._next_available_block(*self._last_location)
+            elif self.layout == 'map':
+                layout, first = 'map', self._map_first
+            else:
+                layout, first = 'chain', self._data_first
+            if first is not None:
+                fm._used_blocks -= self._reserved
+                if fm._add_file_to_table(self.file_name, self.size, first[0], first[1], layout) == 0:
+                    self.closed = True
+                    fm._open_writers.discard(self.file_name)
+                    return 0
+                fm._used_blocks += self._reserved
+            self.abort()
+            return -1
+
+
 class FileManager:
 
     """
@@ -16,8 +234,17 @@ class FileManager:
     file_table_format:
     [0:20]: file_name
     [20:24]: file_size
-    [24:28]: disk_idx
+    [24:28]: disk_idx (| 0x80000000 for the map layout)
     [28:32]: block_idx
+
+    map_block_format (map layout, the entry points to the first map block):
+    [0:4]: entry_num_in_this_block
+    [4:8]: next_map_disk_idx
+    [8:12]: next_map_block_idx
+    [...]: entries of data blocks, [0:4]: disk_idx, [4:8]: block_idx
+    data blocks of both layouts are chained by their headers
+    map blocks are a chain as well (no second index level), so seeking to the k-th data block
+    reads k // map_entry_num map blocks, not a single one
     """
 
     def __init__(self,
@@ -25,7 +252,16 @@ class FileManager:
                  block_size,
                  max_file_num=None,
                  disks=None,
+                 rebuild_workers=None,
+                 health_check_interval=None,
+                 layout='chain',
+                 lazy_delete=False,
+                 cache_size=None,
+                 write_back_size=None,
+                 write_back_interval=None,
                  ):
+        if layout not in ('chain', 'map'):
+            raise Exception('Unknown file layout!')
         if disks is None:
             disks = [
                 ('f', './disks/'),
@@ -41,16 +277,60 @@ class FileManager:
         self.block_num = int(disk_size // block_size)
         self.block_head_size = 12
         self.block_data_size = self.block_size - self.block_head_size
+        # layout of new files, 'chain': linked blocks, 'map': linked blocks and a block map
+        self.layout = layout
+        self._map_flag = 0x80000000
+        self._map_entry_size = 8
+        self._map_entry_num = self.block_data_size // self._map_entry_size
+        # lazy delete: blocks of deleted files are freed at once, zeroed later in background
+        # the blocks waiting to be zeroed are only kept in memory, after a restart they keep
+        # the deleted data until they are reused, call reclaim() before closing to zero them
+        self.lazy_delete = lazy_delete
         # disk_manager
-        self.disk_manager = DiskManager(disk_size, block_size, disks)
+        self.disk_manager = DiskManager(disk_size, block_size, disks, health_check_interval,
+                                        write_back_size=write_back_size,
+                                        write_back_interval=write_back_interval)
+        # write-through block cache of cache_size bytes, None for no cache
+        self._cache = BlockCache(cache_size, block_size) if cache_size else None
         # file_table
         self._max_file_blocks = 0
         self._last_table_disk = 0
         self._last_table_block = 0
         self._table_entry_size = 32
         self._init_file_table(max_file_num)
+        # file directory index, loaded from the table at the first use
+        self._file_index = None  # file_name -> entry
+        self._free_entries = None  # heap of free entry slots (block, disk, offset)
+        # space accounting, kept with the index: data blocks taken by each file
+        self._file_blocks = None  # file_name -> blocks
+        self._used_blocks = 0
+        self._open_writers = set()  # names of files being written by a FileWriter
+        self._file_tails = {}  # file_name -> (last data block, last map block), found at the first append
+        # file_name -> version, dropped when the entry changes, streams check it before every block
+        self._file_versions = {}
+        self._version_clock = itertools.count()
+        # free-block bitmap over (block_idx * disk_num + disk_idx), 1: in use, built at the first use
+        self._block_bitmap = None
+        self._first_free = -1  # no free block before it
+        # freed blocks waiting to be zeroed: block_idx -> {disk_idx, ...}, not persisted
+        self._reclaim_pending = {}
+        self._reclaim_thread = None
+        self._reclaim_batch_size = 16  # stripes zeroed while holding the lock
         # recovery
         self._recovery_time = None
+        self._rebuild_workers = rebuild_workers if rebuild_workers is not None else (os.cpu_count() or 1)
+        self._rebuild_progress = [0, 0]  # [rebuilt stripes, total stripes]
+        self._rebuild_progress_lock = threading.Lock()
+        # degraded mode: failed blocks found by reads are rebuilt in background
+        self._degraded = False
+        self._degraded_stripes = set()
+        self._degraded_full = False  # a disk failed, every stripe has to be rebuilt
+        self._rebuild_thread = None
+        self._rebuild_generation = 0
+        self._rebuild_batch_size = 16
+        self._rebuild_lock = threading.Lock()
+        # operations from other threads (e.g. scrubber) are serialized
+        self._lock = threading.RLock()
 
 
     def _init_file_table(self, max_files):
@@ -109,22 +389,185 @@ class FileManager:
         return b_block[12:12+size]
 
 
+    def _block_pos(self, disk_idx, block_idx):
+        return block_idx * self.disk_num + disk_idx
+
+
+    # build the free-block bitmap: parity, table and blocks on file chains are in use
+    def _load_block_bitmap(self):
+        bitmap = bytearray(self.block_num * self.disk_num)
+        for b in range(self.block_num):
+            bitmap[self._block_pos(self._get_p_disk(b), b)] = 1
+            bitmap[self._block_pos(self._get_q_disk(b), b)] = 1
+        table_end = self._block_pos(self._last_table_disk, self._last_table_block) + 1
+        bitmap[:table_end] = b'\x01' * table_end
+        for entry in self._get_file_index().values():
+            map_locations, locations = self._get_file_locations(entry)
+            for disk_idx, block_idx in map_locations + locations:
+                bitmap[self._block_pos(disk_idx, block_idx)] = 1
+        self._block_bitmap = bitmap
+        self._first_free = bitmap.find(0)
+
+
+    def _get_block_bitmap(self):
+        if self._block_bitmap is None:
+            self._load_block_bitmap()
+        return self._block_bitmap
+
+
+    def _allocate_block(self, disk_idx, block_idx):
+        self._get_block_bitmap()[self._block_pos(disk_idx, block_idx)] = 1
+        # a reused block is overwritten anyway, do not zero it
+        disks = self._reclaim_pending.get(block_idx)
+        if disks is not None:
+            disks.discard(disk_idx)
+            if not disks:
+                del self._reclaim_pending[block_idx]
+
+
+    def _free_block(self, disk_idx, block_idx):
+        pos = self._block_pos(disk_idx, block_idx)
+        self._get_block_bitmap()[pos] = 0
+        if self._first_free == -1 or pos < self._first_free:
+            self._first_free = pos
+
+
+    # free a block now and zero it later
+    def _free_block_lazy(self, disk_idx, block_idx):
+        self._free_block(disk_idx, block_idx)
+        self._reclaim_pending.setdefault(block_idx, set()).add(disk_idx)
+
+
+    # zero pending blocks of count stripes (all if None), p, q are updated once per stripe
+    # no_failure: skip stripes with failures and never recover, raise if a write fails
+    # return the number of stripes zeroed, stripes stay pending until they are written
+    def _reclaim_stripes(self, count=None, no_failure=False):
+        stripes = list(self._reclaim_pending)
+        if no_failure:
+            stripes = [b for b in stripes if self.disk_manager.check_failure(b) == 0]
+        if count is not None:
+            stripes = stripes[:count]
+        data = bytes(self.block_size)
+        blocks = [(data, d, b) for b in stripes for d in self._reclaim_pending[b]]
+        self._write_data_blocks(blocks, no_failure)
+        for b in stripes:
+            del self._reclaim_pending[b]
+        return len(stripes)
+
+
+    # called with the lock held
+    def _schedule_reclaim(self):
+        if self._reclaim_thread is None and self._reclaim_pending:
+            self._reclaim_thread = threading.Thread(target=self._background_reclaim, daemon=True)
+            self._reclaim_thread.start()
+
+
+    # zero freed blocks in batches of stripes, foreground operations can run between batches
+    # failures are left to the recovery, which schedules the reclaim again when it finishes
+    def _background_reclaim(self):
+        while True:
+            with self._lock:
+                done = True
+                try:
+                    if not self._degraded:
+                        done = self._reclaim_stripes(self._reclaim_batch_size, no_failure=True) == 0
+                except Exception:
+                    # a disk failed while writing, the stripes stay pending until the recovery
+                    # anything else is raised (and the thread ends)
+                    if self.disk_manager.check_array() == 0:
+                        raise
+                finally:
+                    if done:
+                        self._reclaim_thread = None
+                if done:
+                    return
+
+
     # given the location of this block, find next available one
     def _next_available_block(self, this_disk, this_block):
-        d, b = this_disk, this_block
-        while True:
-            d += 1
-            if d >= self.disk_num:
-                d = 0
-                b += 1
-            if b >= self.block_num:
+        bitmap = self._get_block_bitmap()
+        start = self._block_pos(this_disk, this_block) + 1
+        if self._first_free == -1:
+            return None  # full
+        if start <= self._first_free:
+            # nothing is free before first_free, move it on while searching from it
+            self._first_free = bitmap.find(0, self._first_free)
+            pos = self._first_free
+        else:
+            pos = bitmap.find(0, start)
+        if pos == -1:
+            return None
+        return pos % self.disk_num, pos // self.disk_num
+
+
+    # find count available blocks after the file directory table, None if there are not enough
+    def _next_available_blocks(self, count):
+        locations = []
+        disk_idx, block_idx = self._last_table_disk, self._last_table_block
+        while len(locations) < count:
+            res = self._next_available_block(disk_idx, block_idx)
+            if res is None:
                 return None
-            if self._get_p_disk(b) == d or self._get_q_disk(b) == d:
-                continue
-            res, block = self._read_block(d, b)
-            size = self._block_get_size(block)
-            if size == 0:
-                return d, b
+            locations.append(res)
+            disk_idx, block_idx = res
+        return locations
+
+
+    # locations of the map blocks and the data blocks of a file, at most count data blocks
+    def _get_file_locations(self, file_entry, count=None):
+        map_locations, locations = [], []
+        if file_entry['file_size'] == 0:
+            return map_locations, locations  # empty file
+        if count is None:
+            count = self._size_to_blocks(file_entry['file_size'])
+        disk_idx, block_idx = file_entry['file_disk'], file_entry['file_block']
+        if file_entry['file_layout'] == 'map':
+            # read the map blocks only
+            while len(locations) < count:
+                res, block = self._read_block(disk_idx, block_idx, view=True)
+                map_locations.append((disk_idx, block_idx))
+                entry_num = self._block_get_size(block)
+                for i in range(entry_num):
+                    pos = self.block_head_size + i * self._map_entry_size
+                    locations.append((int.from_bytes(block[pos:pos+4], 'little'),
+                                      int.from_bytes(block[pos+4:pos+8], 'little')))
+                next_disk = self._block_get_next_disk(block)
+                next_block = self._block_get_next_block(block)
+                if entry_num == 0 or (disk_idx == next_disk and block_idx == next_block):
+                    break
+                disk_idx, block_idx = next_disk, next_block
+            return map_locations, locations[:count]
+        # follow the chain of data blocks
+        while len(locations) < count:
+            res, block = self._read_block(disk_idx, block_idx, view=True)
+            if self._block_get_size(block) == 0:
+                break
+            locations.append((disk_idx, block_idx))
+            next_disk = self._block_get_next_disk(block)
+            next_block = self._block_get_next_block(block)
+            if disk_idx == next_disk and block_idx == next_block:
+                break
+            disk_idx, block_idx = next_disk, next_block
+        return map_locations, locations
+
+
+    # map blocks [(block, disk_idx, block_idx), ...] listing the data block locations, from the first-th one
+    def _make_map_blocks(self, locations, map_locations, first=0):
+        blocks = []
+        for i in range(first, len(map_locations)):
+            disk_idx, block_idx = map_locations[i]
+            entries = locations[i*self._map_entry_num:(i+1)*self._map_entry_num]
+            next_disk, next_block = map_locations[i + 1] if i + 1 < len(map_locations) else (disk_idx, block_idx)
+            block = bytearray()
+            block.extend(len(entries).to_bytes(4, 'little'))
+            block.extend(next_disk.to_bytes(4, 'little'))
+            block.extend(next_block.to_bytes(4, 'little'))
+            for d, b in entries:
+                block.extend(d.to_bytes(4, 'little'))
+                block.extend(b.to_bytes(4, 'little'))
+            block.extend(b'\x00' * (self.block_size - len(block)))
+            blocks.append((block, disk_idx, block_idx))
+        return blocks
 
 
     def _entry_byte_to_dict(self, b_entry, entry_disk, entry_block, entry_offset):
@@ -138,81 +581,128 @@ class FileManager:
         size = int.from_bytes(b_entry[20:24], byteorder='little')
         disk = int.from_bytes(b_entry[24:28], byteorder='little')
         block = int.from_bytes(b_entry[28:32], byteorder='little')
+        layout = 'map' if disk & self._map_flag else 'chain'
         return {
             'entry_disk': entry_disk,
             'entry_block': entry_block,
             'entry_offset': entry_offset,
             'file_name': name,
             'file_size': size,
-            'file_disk': disk,
-            'file_block': block
+            'file_disk': disk & ~self._map_flag,
+            'file_block': block,
+            'file_layout': layout,
         }
 
 
-    # search the file directory table and get an entry
-    def _get_file_entry(self, file_name):
+    def _entry_dict_to_byte(self, file_name, file_size, file_disk, file_block, layout='chain'):
+        if layout == 'map':
+            file_disk |= self._map_flag
+        entry = bytearray(str(file_name).encode('utf-8'))
+        if len(entry) < 20:
+            entry.extend([0] * (20 - len(entry)))
+        entry.extend(file_size.to_bytes(4, 'little'))
+        entry.extend(file_disk.to_bytes(4, 'little'))
+        entry.extend(file_block.to_bytes(4, 'little'))
+        return entry
+
+
+    # load the file directory table into memory: name -> entry, and the free entry slots
+    def _load_file_index(self):
+        index, free, file_blocks = {}, [], {}
         d, b = -1, 0
-        while True:
+        while d != self._last_table_disk or b != self._last_table_block:
             d += 1
             if d >= self.disk_num:
                 d = 0
                 b += 1
             if self._get_p_disk(b) == d or self._get_q_disk(b) == d:
                 continue
-            res, block = self._read_block(d, b)
+            res, block = self._read_block(d, b, view=True)
             # read each entry in a block
             offset = 0
-            while offset < self.block_size:
-                entry = self._entry_byte_to_dict(
-                    block[offset:offset+self._table_entry_size], d, b, offset)
-                if entry['file_name'] is None:
-                    offset += self._table_entry_size
-                    continue
-                if file_name == entry['file_name']:
-                    return entry
+            while offset + self._table_entry_size <= self.block_size:
+                if block[offset] == 0x0:
+                    free.append((b, d, offset))
+                else:
+                    entry = self._entry_byte_to_dict(
+                        bytes(block[offset:offset+self._table_entry_size]), d, b, offset)
+                    index[entry['file_name']] = entry
+                    file_blocks[entry['file_name']] = self._size_to_blocks(entry['file_size'], entry['file_layout'])
                 offset += self._table_entry_size
-            if d == self._last_table_disk and b == self._last_table_block:
-                return None
+        # free slots are taken in table order, the same order as a table scan
+        heapq.heapify(free)
+        self._file_index, self._free_entries = index, free
+        self._file_blocks, self._used_blocks = file_blocks, sum(file_blocks.values())
+
+
+    # data blocks needed by a file of this size, with its map blocks for the map layout
+    def _size_to_blocks(self, file_size, layout='chain'):
+        blocks = -(-file_size // self.block_data_size)
+        if layout == 'map':
+            blocks += -(-blocks // self._map_entry_num)
+        return blocks
+
+
+    def _get_file_index(self):
+        if self._file_index is None:
+            self._load_file_index()
+        return self._file_index
+
+
+    # get an entry from the file directory index
+    def _get_file_entry(self, file_name):
+        return self._get_file_index().get(file_name)
 
 
     # add an entry into the file directory table
-    def _add_file_to_table(self, file_name, file_size, file_disk, file_block):
-        d, b = -1, 0
-        while d != self._last_table_disk or b != self._last_table_block:
-            d += 1
-            if d >= self.disk_num:
-                d = 0
-                b += 1
-            if self._get_p_disk(b) == d or self._get_q_disk(b) == d:
-                continue
-            res, block = self._read_block(d, b)
-            offset = 0
-            while offset < len(block):
-                if block[offset] != 0x0:  # already has a file
-                    offset += self._table_entry_size
-                    continue
-                # new entry
-                entry = bytearray(str(file_name).encode('utf-8'))
-                if len(entry) < 20:
-                    entry.extend([0] * (20 - len(entry)))
-                entry.extend(file_size.to_bytes(4, 'little'))
-                entry.extend(file_disk.to_bytes(4, 'little'))
-                entry.extend(file_block.to_bytes(4, 'little'))
-                block[offset:offset+self._table_entry_size] = entry
-                self._write_block(block, d, b)
-                self._reset_pq(b)
-                return 0
-        return -1
+    def _add_file_to_table(self, file_name, file_size, file_disk, file_block, layout='chain'):
+        index = self._get_file_index()
+        if not self._free_entries:
+            return -1
+        b, d, offset = heapq.heappop(self._free_entries)
+        res, block = self._read_block(d, b)
+        old_block = block.copy()
+        # new entry
+        entry = self._entry_dict_to_byte(file_name, file_size, file_disk, file_block, layout)
+        block[offset:offset+self._table_entry_size] = entry
+        self._write_data_block(block, d, b, old_block)
+        index[file_name] = self._entry_byte_to_dict(entry, d, b, offset)
+        self._file_blocks[file_name] = self._size_to_blocks(file_size, layout)
+        self._used_blocks += self._file_blocks[file_name]
+        return 0
+
+
+    # rewrite an entry of the file directory table in place
+    def _update_file_entry(self, file_entry, file_size, file_disk, file_block, layout):
+        file_name = file_entry['file_name']
+        d, b, offset = file_entry['entry_disk'], file_entry['entry_block'], file_entry['entry_offset']
+        res, block = self._read_block(d, b)
+        old_block = block.copy()
+        entry = self._entry_dict_to_byte(file_name, file_size, file_disk, file_block, layout)
+        block[offset:offset+self._table_entry_size] = entry
+        self._write_data_block(block, d, b, old_block)
+        self._file_index[file_name] = self._entry_byte_to_dict(entry, d, b, offset)
+        self._file_tails.pop(file_name, None)
+        self._file_versions.pop(file_name, None)
+        blocks = self._size_to_blocks(file_size, layout)
+        self._used_blocks += blocks - self._file_blocks[file_name]
+        self._file_blocks[file_name] = blocks
 
 
     # find a file entry and delete it from the table
     def _del_file_from_table(self, file_entry):
         d, b = file_entry['entry_disk'], file_entry['entry_block']
         res, block = self._read_block(d, b)
+        old_block = block.copy()
         offset = file_entry['entry_offset']
         block[offset:offset+self._table_entry_size] = bytearray(b'\x00' * self._table_entry_size)
-        self._write_block(block, d, b)
-        self._reset_pq(b)
+        self._write_data_block(block, d, b, old_block)
+        index = self._get_file_index()
+        self._file_tails.pop(file_entry['file_name'], None)
+        self._file_versions.pop(file_entry['file_name'], None)
+        if index.pop(file_entry['file_name'], None) is not None:
+            self._used_blocks -= self._file_blocks.pop(file_entry['file_name'])
+        heapq.heappush(self._free_entries, (b, d, offset))
 
 
     # change indexes to invoke recovery algorithm: [... p, q, ...] -> [...... p, q]
@@ -242,37 +732,33 @@ class FileManager:
 
 
     def _recover_stripe_blocks_from_failure(self, strip_blocks, failed_disks):
-        if len(failed_disks) == 1:
-            new_blocks = [bytearray()]
-            for i in range(self.block_size):
-                # arrange an array for every offset
-                arr = [strip_blocks[d][i] for d in range(len(strip_blocks))]
-                recover = failure_fix(arr, failed_disks)
-                new_blocks[0].append(recover[0])
-            return new_blocks
-        elif len(failed_disks) == 2:
-            new_blocks = [bytearray(), bytearray()]
-            for i in range(self.block_size):
-                # arrange an array for every offset
-                arr = [strip_blocks[d][i] for d in range(len(strip_blocks))]
-                recover = failure_fix(arr, failed_disks)
-                new_blocks[0].append(recover[0])
-                new_blocks[1].append(recover[1])
-            return new_blocks
+        # coefficients are computed once per failure pattern, blocks are recovered as a whole
+        return failure_fix_blocks(strip_blocks, failed_disks)
 
 
-    # recover a single stripe (block_idx is stripe index)
-    def _recover_stripe_from_failure(self, block_idx):
+    # recover the blocks of failed disks in a stripe (block_idx is stripe index), return {disk_idx: block}
+    def _recover_stripe_blocks(self, block_idx, failed_disks=None):
         p_idx, q_idx = self._get_p_disk(block_idx), self._get_q_disk(block_idx)
         block_stripe, pq_blocks = [], [None, None]
-        failed_disks = []
+        failed_disks = [] if failed_disks is None else list(failed_disks)
         for d in range(self.disk_num):
-            if self.disk_manager.check_block(d, block_idx) != 0:
+            if d not in failed_disks and self.disk_manager.check_block(d, block_idx) != 0:
                 failed_disks.append(d)
-                if len(failed_disks) > 2:
-                    raise Exception('Failure in more than 2 disks of a stripe!')
+        # read the rest, blocks failing to be read are also recovered
+        stripe = {}
+        if len(failed_disks) <= 2:
+            disks = [d for d in range(self.disk_num) if d not in failed_disks]
+            results = self.disk_manager.read_blocks([(d, block_idx) for d in disks])
+            for d, (res, block_data) in zip(disks, results):
+                if res != 0:
+                    failed_disks.append(d)
+                else:
+                    stripe[d] = block_data
+        if len(failed_disks) > 2:
+            raise Exception('Failure in more than 2 disks of a stripe!')
         if len(failed_disks) == 0:
-            return
+            return {}
+        failed_disks.sort()
         # calculate the indexes in file system and recovery algorithm
         algo_disks = []
         for d in failed_disks:
@@ -283,7 +769,7 @@ class FileManager:
         # change the data into the form fitting the recovery algorithm
         for d in range(self.disk_num):
             if d not in failed_disks:
-                res, block_data = self.disk_manager.read_block(d, block_idx)
+                block_data = stripe[d]
             else:
                 block_data = bytearray(b'\x00' * self.block_size)
             if d == p_idx:
@@ -295,9 +781,39 @@ class FileManager:
         block_stripe.extend(pq_blocks)
         # recover from a stripe of block data
         res = self._recover_stripe_blocks_from_failure(block_stripe, algo_disks)
-        self._write_block(res[0], failed_disks[0], block_idx, force=True)
-        if len(failed_disks) == 2:
-            self._write_block(res[1], failed_disks[1], block_idx, force=True)
+        return dict(zip(failed_disks, res))
+
+
+    # recover a single stripe (block_idx is stripe index)
+    def _recover_stripe_from_failure(self, block_idx):
+        recovered = self._recover_stripe_blocks(block_idx)
+        for d, block in recovered.items():
+            self._write_block(block, d, block_idx, force=True)
+
+
+    # recover stripes with a pool of workers, each of them takes a range of stripes
+    def _rebuild_stripes(self, stripes, keep_progress=False):
+        stripes = list(stripes)
+        if not keep_progress:
+            with self._rebuild_progress_lock:
+                self._rebuild_progress = [0, len(stripes)]
+        workers = max(1, min(self._rebuild_workers, len(stripes)))
+        if workers == 1:
+            self._rebuild_stripe_range(stripes)
+            return
+        # several ranges per worker to balance the load
+        chunk = max(1, -(-len(stripes) // (workers * 4)))
+        ranges = [stripes[i:i+chunk] for i in range(0, len(stripes), chunk)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(self._rebuild_stripe_range, ranges):
+                pass
+
+
+    def _rebuild_stripe_range(self, stripes):
+        for b in stripes:
+            self._recover_stripe_from_failure(b)
+            with self._rebuild_progress_lock:
+                self._rebuild_progress[0] += 1
 
 
     def _recover_from_failure(self, block_idx):
@@ -308,78 +824,213 @@ class FileManager:
                 failed_disks.append(i)
                 if len(failed_disks) > 2:
                     raise Exception('Failure in more than 2 disks!')
-        if len(failed_disks) > 0:
+        if len(failed_disks) > 0 or self._degraded_full:
             # recover every stripe
-            for b in range(self.block_num):
-                self._recover_stripe_from_failure(b)
+            self._rebuild_stripes(range(self.block_num))
         else:
-            # recover only one stripe (blocks failed in a stripe, not realized yet)
-            self._recover_stripe_from_failure(block_idx)
+            # recover only the stripes with failed blocks (not realized yet, or found by degraded reads)
+            with self._rebuild_lock:
+                stripes = self._degraded_stripes | {block_idx}
+            self._rebuild_stripes(sorted(stripes))
+        with self._rebuild_lock:
+            # a scheduled background rebuild is no longer needed
+            self._rebuild_generation += 1
+            self._degraded_stripes = set()
+            self._degraded_full = False
+            self._degraded = False
         t1 = time.time()
         self._recovery_time = t1 - t0
-
-
-    def _read_block(self, disk_idx, block_idx, no_failure=False):
-        res, data = self.disk_manager.read_block(disk_idx, block_idx)
+        self._schedule_reclaim()
+
+
+    # start a background rebuild if there is none
+    def _schedule_rebuild(self, block_idx, full=False):
+        with self._rebuild_lock:
+            self._degraded_stripes.add(block_idx)
+            self._degraded_full = self._degraded_full or full
+            self._degraded = True
+            if self._rebuild_thread is None:
+                self._rebuild_thread = threading.Thread(target=self._background_rebuild, daemon=True)
+                self._rebuild_thread.start()
+
+
+    # rebuild in batches of stripes, foreground operations can run between batches
+    def _background_rebuild(self):
+        try:
+            t0 = time.time()
+            rebuilt = set()
+            batch = max(1, self._rebuild_workers) * self._rebuild_batch_size
+            while True:
+                with self._lock:
+                    disk_failed = any(self.disk_manager.check_disk(i) != 0 for i in range(self.disk_num))
+                    with self._rebuild_lock:
+                        generation = self._rebuild_generation
+                        if not self._degraded:
+                            # finished by a foreground recovery
+                            self._rebuild_thread = None
+                            return
+                        self._degraded_full = self._degraded_full or disk_failed
+                        if self._degraded_full:
+                            stripes = sorted(set(range(self.block_num)) - rebuilt)
+                        else:
+                            stripes = sorted(self._degraded_stripes - rebuilt)
+                        if len(stripes) == 0:
+                            self._rebuild_generation += 1
+                            self._degraded_stripes = set()
+                            self._degraded_full = False
+                            self._degraded = False
+                            self._rebuild_thread = None
+                            self._recovery_time = time.time() - t0
+                            self._schedule_reclaim()
+                            return
+                with self._rebuild_progress_lock:
+                    self._rebuild_progress = [0, len(stripes)]
+                for i in range(0, len(stripes), batch):
+                    with self._lock:
+                        if generation != self._rebuild_generation:
+                            break  # a foreground recovery happened, check again
+                        self._rebuild_stripes(stripes[i:i+batch], keep_progress=True)
+                else:
+                    rebuilt.update(stripes)
+        finally:
+            with self._rebuild_lock:
+                # a failed batch must not keep the next rebuild from starting
+                if self._rebuild_thread is threading.current_thread():
+                    self._rebuild_thread = None
+
+
+    # view: the block is only read, img disks return it without copying
+    # no_failure reads (corruption checks) bypass the cache
+    def _read_block(self, disk_idx, block_idx, no_failure=False, view=False):
+        cache = None if no_failure else self._cache
+        if cache is not None:
+            block = cache.get(disk_idx, block_idx)
+            if block is not None:
+                return 0, block if view else bytearray(block)
+            token = cache.token()
+        if view:
+            res, data = self.disk_manager.read_block_view(disk_idx, block_idx)
+        else:
+            res, data = self.disk_manager.read_block(disk_idx, block_idx)
         if res != 0:
             if no_failure:
                 raise Exception('Unable to handle failure!')
-            self._recover_from_failure(block_idx)
-            res, data = self.disk_manager.read_block(disk_idx, block_idx)
-            if res != 0:
-                raise Exception('Unable to handle failure after recovery!')
+            # degraded read: recover only this block, the rest is rebuilt in background
+            data = self._recover_stripe_blocks(block_idx, [disk_idx])[disk_idx]
+            self._schedule_rebuild(block_idx, full=self.disk_manager.check_disk(disk_idx) != 0)
+            res = 0
+        if cache is not None:
+            cache.fill(disk_idx, block_idx, data, token)
         return res, data
 
 
+    # read blocks [(disk_idx, block_idx), ...] at the same time
+    def _read_blocks(self, locations, no_failure=False, view=False):
+        cache = None if no_failure else self._cache
+        blocks = [None] * len(locations)
+        missed = []
+        if cache is not None:
+            token = cache.token()
+            for i, (disk_idx, block_idx) in enumerate(locations):
+                block = cache.get(disk_idx, block_idx)
+                if block is None:
+                    missed.append(i)
+                else:
+                    blocks[i] = block if view else bytearray(block)
+        else:
+            missed = list(range(len(locations)))
+        results = self.disk_manager.read_blocks([locations[i] for i in missed], view=view)
+        for i, (res, data) in zip(missed, results):
+            disk_idx, block_idx = locations[i]
+            if res != 0:
+                # handle the failure as a single read
+                res, data = self._read_block(disk_idx, block_idx, no_failure, view)
+            elif cache is not None:
+                cache.fill(disk_idx, block_idx, data, token)
+            blocks[i] = data
+        return blocks
+
+
+    # write blocks [(block, disk_idx, block_idx), ...] at the same time
+    def _write_blocks(self, blocks, no_failure=False):
+        if self._degraded:
+            results = [-1] * len(blocks)  # finish the rebuild in _write_block first
+        else:
+            results = self.disk_manager.write_blocks(blocks)
+        for (block, disk_idx, block_idx), res in zip(blocks, results):
+            if res != 0:
+                # handle the failure as a single write
+                self._write_block(block, disk_idx, block_idx, no_failure)
+            elif self._cache is not None:
+                self._cache.put(disk_idx, block_idx, block)
+
+
     def _write_block(self, block, disk_idx, block_idx, no_failure=False, force=False):
+        if self._degraded and not force and not no_failure:
+            # writes finish the pending rebuild first
+            self._recover_from_failure(block_idx)
         res = self.disk_manager.write_block(block, disk_idx, block_idx, force=force)
         if res != 0:
+            if self._cache is not None:
+                self._cache.invalidate(disk_idx, block_idx)
             if no_failure:
                 raise Exception('Unable to handle failure!')
             self._recover_from_failure(block_idx)
             res = self.disk_manager.write_block(block, disk_idx, block_idx, force=force)
             if res != 0:
                 raise Exception('Unable to handle failure after recovery!')
+        if self._cache is not None:
+            self._cache.put(disk_idx, block_idx, block)
         return res
 
 
-    # calculate p, q value
-    def _cal_block_pq(self, block_idx):
-        blocks = []
-        for i in range(self.disk_num):
-            if i != self._get_p_disk(block_idx) and i != self._get_q_disk(block_idx):
-                res, block_data = self._read_block(i, block_idx)
-                blocks.append(block_data)
-        block_p, block_q = bytearray(), bytearray()
-        for j in range(self.block_size):
-            arr = [blocks[i][j] for i in range(len(blocks))]
-            arr.extend([0, 0])  # move p q to the end of array
-            res = compute_PQ(arr)
-            block_p.append(res[0])
-            block_q.append(res[1])
-        return block_p, block_q
-
-
-    def _reset_pq(self, block_idx):
-        block_p, block_q = self._cal_block_pq(block_idx)
-        self._write_block(block_p, self._get_p_disk(block_idx), block_idx)
-        self._write_block(block_q, self._get_q_disk(block_idx), block_idx)
-
-
-    def _able_to_add_file(self, file_name, file_size):
-        entries = self.list_files()
-        occupied_blocks = 0
-        for e in entries:
-            if e['file_name'] == file_name:
-                return -2  # already has a file
-            blocks = e['file_size'] // self.block_size
-            if blocks * self.block_size != e['file_size']:
-                blocks += 1
-            occupied_blocks += blocks
-        new_blocks = file_size // self.block_size
-        if new_blocks * self.block_size != file_size:
-            new_blocks += 1
-        if occupied_blocks + new_blocks > self._max_file_blocks:
+    # write data blocks [(block, disk_idx, block_idx), ...] and update p, q once per stripe
+    def _write_data_blocks(self, blocks, no_failure=False):
+        stripes = {}
+        for block, disk_idx, block_idx in blocks:
+            stripes.setdefault(block_idx, {})[disk_idx] = block
+        for block_idx, stripe in stripes.items():
+            p_idx, q_idx = self._get_p_disk(block_idx), self._get_q_disk(block_idx)
+            data_disks = [d for d in range(self.disk_num) if d != p_idx and d != q_idx]
+            if self.disk_num - 2 - len(stripe) <= len(stripe) + 2:
+                # (nearly) full stripe: calculate p, q from the data blocks
+                rest = [(d, block_idx) for d in data_disks if d not in stripe]
+                rest_blocks = dict(zip(rest, self._read_blocks(rest, view=True)))
+                data = [stripe[d] if d in stripe else rest_blocks[(d, block_idx)] for d in data_disks]
+                block_p, block_q = compute_PQ_blocks(data)
+            else:
+                # update p, q with the delta of every written block
+                disks = list(stripe)
+                old_blocks = self._read_blocks([(d, block_idx) for d in [p_idx, q_idx] + disks], view=True)
+                block_p, block_q = old_blocks[0], old_blocks[1]
+                for d, old_block in zip(disks, old_blocks[2:]):
+                    algo_idx = self._disk_real_to_algo(d, p_idx, q_idx)
+                    block_p, block_q = update_PQ_blocks(block_p, block_q, old_block, stripe[d], algo_idx)
+            writes = [(block, d, block_idx) for d, block in stripe.items()]
+            writes.append((block_p, p_idx, block_idx))
+            writes.append((block_q, q_idx, block_idx))
+            self._write_blocks(writes, no_failure)
+
+
+    # write a data block and update p, q with its delta, other blocks in the stripe are not read
+    def _write_data_block(self, block, disk_idx, block_idx, old_block=None):
+        p_idx, q_idx = self._get_p_disk(block_idx), self._get_q_disk(block_idx)
+        locations = [(p_idx, block_idx), (q_idx, block_idx)]
+        if old_block is None:
+            locations.append((disk_idx, block_idx))
+        old_blocks = self._read_blocks(locations, view=True)
+        block_p, block_q = old_blocks[0], old_blocks[1]
+        if old_block is None:
+            old_block = old_blocks[2]
+        algo_idx = self._disk_real_to_algo(disk_idx, p_idx, q_idx)
+        block_p, block_q = update_PQ_blocks(block_p, block_q, old_block, block, algo_idx)
+        self._write_blocks([(block, disk_idx, block_idx), (block_p, p_idx, block_idx), (block_q, q_idx, block_idx)])
+
+
+    def _able_to_add_file(self, file_name, file_size, layout='chain'):
+        if file_name in self._get_file_index() or file_name in self._open_writers:
+            return -2  # already has a file
+        if self._used_blocks + self._size_to_blocks(file_size, layout) > self._max_file_blocks:
             return -1  # no enough spaces
         return 0
 
@@ -387,29 +1038,21 @@ class FileManager:
     def _able_to_modify_file(self, file_name, begin, end, new_size):
         if begin > end:
             return -1, None  # invalid params
-        entries = self.list_files()
-        occupied_blocks = 0
-        entry = None
-        for e in entries:
-            if e['file_name'] == file_name:
-                if begin < 0 or begin > e['file_size'] or end < 0 or end > e['file_size']:
-                    return -1, None  # invalid params
-                size_change = new_size - (end - begin)
-                if size_change == 0:
-                    return 0, e  # no change
-                f_size = e['file_size'] + size_change  # new size
-                entry = e
-            else:
-                f_size = e['file_size']  # existing size
-            blocks = f_size // self.block_size
-            if blocks * self.block_size != f_size:
-                blocks += 1
-            occupied_blocks += blocks
-        if occupied_blocks > self._max_file_blocks or entry is None:
+        entry = self._get_file_index().get(file_name)
+        if entry is None:
+            return -1, None  # no such file
+        if begin < 0 or begin > entry['file_size'] or end < 0 or end > entry['file_size']:
+            return -1, None  # invalid params
+        size_change = new_size - (end - begin)
+        if size_change == 0:
+            return 0, entry  # no change
+        new_blocks = self._size_to_blocks(entry['file_size'] + size_change, entry['file_layout'])
+        if self._used_blocks - self._file_blocks[file_name] + new_blocks > self._max_file_blocks:
             return -1, None  # no enough spaces
         return 0, entry
 
 
+    @_synchronized
     def read_file(self, file_name, file_entry=None):
         # read entry
         if file_entry is None:
@@ -419,10 +1062,16 @@ class FileManager:
         data = bytearray()
         if file_entry['file_size'] == 0:
             return data  # empty file
+        if file_entry['file_layout'] == 'map':
+            # every location is known, read them at the same time
+            map_locations, locations = self._get_file_locations(file_entry)
+            for block in self._read_blocks(locations, view=True):
+                data.extend(self._block_get_data(block))
+            return data
         disk_idx, block_idx = file_entry['file_disk'], file_entry['file_block']
         has_next = True
         while has_next:
-            res, block = self._read_block(disk_idx, block_idx)
+            res, block = self._read_block(disk_idx, block_idx, view=True)
             size = self._block_get_size(block)
             if size == 0:
                 break
@@ -435,150 +1084,496 @@ class FileManager:
         return data
 
 
-    def add_file(self, file_name, b_data):
-        res = self._able_to_add_file(file_name, len(b_data))
+    # version of a file, a new one (never used before) after its entry is changed or deleted
+    def _get_file_version(self, file_name):
+        version = self._file_versions.get(file_name)
+        if version is None:
+            version = self._file_versions[file_name] = next(self._version_clock)
+        return version
+
+
+    # read a block of a stream, its blocks may belong to another file once the file is changed
+    def _read_stream_block(self, file_name, version, disk_idx, block_idx):
+        with self._lock:
+            if self._get_file_version(file_name) != version:
+                raise Exception('File changed while reading!')
+            return self._read_block(disk_idx, block_idx)[1]
+
+
+    # yield (block_data_idx, block) of a file from its first-th data block, one block in memory
+    def _iter_file_blocks(self, file_entry, version, first=0):
+        if file_entry['file_size'] == 0:
+            return  # empty file
+        file_name = file_entry['file_name']
+        disk_idx, block_idx = file_entry['file_disk'], file_entry['file_block']
+        if file_entry['file_layout'] == 'map':
+            # skip the map blocks before the first-th data block (each is read to find the next one),
+            # then read the data blocks it lists
+            k = 0
+            while True:
+                map_block = self._read_stream_block(file_name, version, disk_idx, block_idx)
+                entry_num = self._block_get_size(map_block)
+                for i in range(max(first - k, 0), entry_num):
+                    pos = self.block_head_size + i * self._map_entry_size
+                    d = int.from_bytes(map_block[pos:pos+4], 'little')
+                    b = int.from_bytes(map_block[pos+4:pos+8], 'little')
+                    yield k + i, self._read_stream_block(file_name, version, d, b)
+                k += entry_num
+                next_disk = self._block_get_next_disk(map_block)
+                next_block = self._block_get_next_block(map_block)
+                if entry_num == 0 or (disk_idx == next_disk and block_idx == next_block):
+                    return
+                disk_idx, block_idx = next_disk, next_block
+        # follow the chain, blocks before the first-th one are read for their headers only
+        k = 0
+        while True:
+            block = self._read_stream_block(file_name, version, disk_idx, block_idx)
+            if self._block_get_size(block) == 0:
+                return
+            if k >= first:
+                yield k, block
+            next_disk = self._block_get_next_disk(block)
+            next_block = self._block_get_next_block(block)
+            if disk_idx == next_disk and block_idx == next_block:
+                return
+            disk_idx, block_idx = next_disk, next_block
+            k += 1
+
+
+    def _iter_range(self, file_entry, version, begin, end):
+        if begin >= end:
+            return
+        for k, block in self._iter_file_blocks(file_entry, version, begin // self.block_data_size):
+            offset = k * self.block_data_size
+            if offset >= end:
+                return
+            size = self._block_get_size(block)
+            start = max(begin - offset, 0)
+            stop = min(end - offset, size)
+            yield memoryview(block)[self.block_head_size+start:self.block_head_size+stop]
+
+
+    # iterator of memoryview chunks (one per block) of [offset, offset+length), None if not found
+    # the lock is only held while reading a block, raise if the file is changed or deleted meanwhile
+    @_synchronized
+    def read_range(self, file_name, offset=0, length=None):
+        file_entry = self._get_file_entry(file_name)
+        if file_entry is None:
+            return None
+        file_size = file_entry['file_size']
+        if offset < 0 or offset > file_size or (length is not None and length < 0):
+            return None  # invalid params
+        end = file_size if length is None else min(offset + length, file_size)
+        return self._iter_range(dict(file_entry), self._get_file_version(file_name), offset, end)
+
+
+    # iterator of memoryview chunks of a whole file, None if not found
+    def open_stream(self, file_name):
+        return self.read_range(file_name)
+
+
+    # start writing a new file, return (0, writer) or (error, None)
+    @_synchronized
+    def open_for_write(self, file_name, expected_size=None, layout=None):
+        if layout is None:
+            layout = self.layout
+        res = self._able_to_add_file(file_name, expected_size or 0, layout)
+        if res != 0:
+            return res, None
+        self._open_writers.add(file_name)
+        return 0, FileWriter(self, file_name, layout)
+
+
+    # b_data: bytes, a readable file object, or an iterable of bytes chunks
+    @_synchronized
+    def add_file(self, file_name, b_data, layout=None):
+        if layout is None:
+            layout = self.layout
+        if not isinstance(b_data, (bytes, bytearray, memoryview)):
+            # stream the data, one stripe of data is read at a time
+            if hasattr(b_data, 'read'):
+                chunk_size = self.block_data_size * (self.disk_num - 2)
+                b_data = iter(functools.partial(b_data.read, chunk_size), b'')
+            res, writer = self.open_for_write(file_name, layout=layout)
+            if res != 0:
+                return res
+            try:
+                for chunk in b_data:
+                    if writer.write(chunk) != 0:
+                        writer.abort()
+                        return -1
+            except BaseException:
+                # the source failed, drop what is written so far
+                writer.abort()
+                raise
+            return writer.close()
+        if len(b_data) == 0:
+            layout = 'chain'  # empty file, no blocks to map
+        res = self._able_to_add_file(file_name, len(b_data), layout)
         if res != 0:
             return res
-        # first available disk
-        res = self._next_available_block(self._last_table_disk, self._last_table_block)
-        if res is None:
+        # allocate the map blocks and the data blocks
+        data_num = self._size_to_blocks(len(b_data))
+        map_num = self._size_to_blocks(len(b_data), layout) - data_num
+        locations = self._next_available_blocks(max(map_num + data_num, 1))
+        if locations is None:
             return -1
-        disk_idx, block_idx = res
+        map_locations, locations = locations[:map_num], locations[map_num:]
+        disk_idx, block_idx = map_locations[0] if map_locations else locations[0]
         # write table entry
-        res = self._add_file_to_table(file_name, len(b_data), disk_idx, block_idx)
+        res = self._add_file_to_table(file_name, len(b_data), disk_idx, block_idx, layout)
         if res != 0:
             return -1
-        # write data
-        offset = 0
-        while offset < len(b_data):
-            if len(b_data) - offset > self.block_data_size:
-                tmp = self._next_available_block(disk_idx, block_idx)
-                if tmp is None:
-                    # failed to add, just remove
-                    self.del_file(file_name)
-                    return -1
-                next_disk, next_block = tmp
-                block = bytearray()
-                block.extend(self.block_data_size.to_bytes(4, 'little'))
-                # point to next disk
-                block.extend(next_disk.to_bytes(4, 'little'))
-                block.extend(next_block.to_bytes(4, 'little'))
-                block.extend(b_data[offset:offset+self.block_data_size])
-                self._write_block(block, disk_idx, block_idx)
-                self._reset_pq(block_idx)
-                disk_idx, block_idx = next_disk, next_block
-                offset += self.block_data_size
-            else:
-                # last block
-                block = bytearray()
-                block.extend((len(b_data) - offset).to_bytes(4, 'little'))
-                # point to this disk
-                block.extend(disk_idx.to_bytes(4, 'little'))
-                block.extend(block_idx.to_bytes(4, 'little'))
-                block.extend(b_data[offset:])
-                block.extend(b'\x00' * (self.block_data_size - len(b_data) + offset))
-                self._write_block(block, disk_idx, block_idx)
-                self._reset_pq(block_idx)
-                offset = len(b_data)
+        # write data, blocks are buffered and written one stripe at a time
+        blocks = self._make_map_blocks(locations, map_locations)
+        for i in range(data_num):
+            disk_idx, block_idx = locations[i]
+            offset = i * self.block_data_size
+            size = min(len(b_data) - offset, self.block_data_size)
+            # point to next block, the last block points to itself
+            next_disk, next_block = locations[i + 1] if i + 1 < data_num else locations[i]
+            block = bytearray()
+            block.extend(size.to_bytes(4, 'little'))
+            block.extend(next_disk.to_bytes(4, 'little'))
+            block.extend(next_block.to_bytes(4, 'little'))
+            block.extend(b_data[offset:offset+size])
+            block.extend(b'\x00' * (self.block_data_size - size))
+            blocks.append((block, disk_idx, block_idx))
+        stripe_blocks = []
+        for block, disk_idx, block_idx in blocks:
+            if stripe_blocks and stripe_blocks[0][2] != block_idx:
+                self._write_data_blocks(stripe_blocks)
+                stripe_blocks = []
+            stripe_blocks.append((block, disk_idx, block_idx))
+            self._allocate_block(disk_idx, block_idx)
+        self._write_data_blocks(stripe_blocks)
         return 0
 
 
-    def del_file(self, file_name):
+    # lazy: free the blocks and zero them in background, None for the lazy_delete option
+    @_synchronized
+    def del_file(self, file_name, lazy=None):
         # read entry
         file_entry = self._get_file_entry(file_name)
         if file_entry is None:
             return -1  # no such file
-        disk_idx, block_idx = file_entry['file_disk'], file_entry['file_block']
+        map_locations, locations = self._get_file_locations(file_entry)
         # delete entry
         self._del_file_from_table(file_entry)
-        if file_entry['file_size'] == 0:
-            return 0  # empty file
-        while True:
-            # delete file data
-            res, block = self._read_block(disk_idx, block_idx)
-            size = self._block_get_size(block)
-            next_disk = self._block_get_next_disk(block)
-            next_block = self._block_get_next_block(block)
-            data = bytearray(b'\x00' * self.block_size)
-            self._write_block(data, disk_idx, block_idx)
-            self._reset_pq(block_idx)
-            if size == 0:
-                break
-            if disk_idx == next_disk and block_idx == next_block:
-                break
-            disk_idx, block_idx = next_disk, next_block
+        if lazy is None:
+            lazy = self.lazy_delete
+        if lazy:
+            for d, b in map_locations + locations:
+                self._free_block_lazy(d, b)
+            self._schedule_reclaim()
+            return 0
+        # delete file data
+        data = bytes(self.block_size)
+        self._write_data_blocks([(data, d, b) for d, b in map_locations + locations])
+        for d, b in map_locations + locations:
+            self._free_block(d, b)
         return 0
 
 
+    @_synchronized
     def modify_file(self, file_name, begin, end, b_data):
         res = self._able_to_modify_file(file_name, begin, end, len(b_data))
         if res[0] != 0 or res[1] is None:
             return res[0]
         file_entry = res[1]
-        file_size = file_entry['file_size']
         # change the file size
         if len(b_data) != end - begin:
-            f_data = self.read_file(file_name, file_entry)
-            new_data = bytearray()
-            new_data.extend(f_data[0:begin])
-            new_data.extend(b_data)
-            new_data.extend(f_data[end:file_size])
-            # delete and re-add
-            self.del_file(file_name)
-            return self.add_file(file_name, new_data)
+            return self._splice_file(file_entry, begin, end, b_data)
         # keep the same size
         if begin == end:
             return -1
-        offset = 0
-        disk_idx, block_idx = file_entry['file_disk'], file_entry['file_block']
-        while offset <= end:
-            res, block = self._read_block(disk_idx, block_idx)
-            if offset + self.block_data_size <= begin:
-                # do not reach begin
-                offset += self.block_data_size
-                disk_idx = self._block_get_next_disk(block)
-                block_idx = self._block_get_next_block(block)
-                continue
-            # modify the block
+        # only the blocks holding [begin, end) are read and written
+        first, last = begin // self.block_data_size, (end - 1) // self.block_data_size
+        map_locations, locations = self._get_file_locations(file_entry, last + 1)
+        locations = locations[first:]
+        blocks = []
+        for i, block in enumerate(self._read_blocks(locations)):
+            offset = (first + i) * self.block_data_size
             block_start = self.block_head_size + max(begin - offset, 0)
             data_start = max(offset - begin, 0)
             data_size = min(end - offset, self.block_data_size) - max(begin - offset, 0)
             block[block_start:block_start+data_size] = b_data[data_start:data_start+data_size]
-            self._write_block(block, disk_idx, block_idx)
-            self._reset_pq(block_idx)
-            # find next block
-            disk_idx = self._block_get_next_disk(block)
-            block_idx = self._block_get_next_block(block)
-            offset += self.block_data_size
+            blocks.append((block, locations[i][0], locations[i][1]))
+        self._write_data_blocks(blocks)
         return 0
 
 
+    # replace [begin, end) of a file with data of another size
+    # blocks before the edit are kept, the rest are rewritten in their old locations
+    def _splice_file(self, file_entry, begin, end, b_data):
+        layout = file_entry['file_layout']
+        map_locations, locations = self._get_file_locations(file_entry)
+        first = begin // self.block_data_size
+        # data from the first changed block to the end
+        old_tail = bytearray()
+        for block in self._read_blocks(locations[first:], view=True):
+            old_tail.extend(self._block_get_data(block))
+        tail_offset = first * self.block_data_size
+        tail = old_tail[:begin-tail_offset] + b_data + old_tail[end-tail_offset:]
+        new_size = tail_offset + len(tail)
+        data_num = self._size_to_blocks(new_size)
+        map_num = self._size_to_blocks(new_size, layout) - data_num
+        # keep the old locations, allocate or free the difference
+        data_extra = max(data_num - len(locations), 0)
+        map_extra = max(map_num - len(map_locations), 0)
+        new_locations = self._next_available_blocks(data_extra + map_extra)
+        if new_locations is None:
+            return -1
+        for d, b in new_locations:
+            self._allocate_block(d, b)
+        old_num = len(locations)
+        freed = locations[data_num:] + map_locations[map_num:]
+        locations = locations[:data_num] + new_locations[:data_extra]
+        map_locations = map_locations[:map_num] + new_locations[data_extra:]
+        if 0 < first and (data_num <= first or first >= old_num):
+            # the edit starts a block, the one before it gets a new next pointer
+            first -= 1
+            res, block = self._read_block(*locations[first])
+            tail = bytearray(self._block_get_data(block)) + tail
+        blocks = []
+        for i in range(first, data_num):
+            chunk = tail[(i-first)*self.block_data_size:(i-first+1)*self.block_data_size]
+            next_disk, next_block = locations[i + 1] if i + 1 < data_num else locations[i]
+            block = bytearray()
+            block.extend(len(chunk).to_bytes(4, 'little'))
+            block.extend(next_disk.to_bytes(4, 'little'))
+            block.extend(next_block.to_bytes(4, 'little'))
+            block.extend(chunk)
+            block.extend(b'\x00' * (self.block_data_size - len(chunk)))
+            blocks.append((block, locations[i][0], locations[i][1]))
+        if map_num > 0:
+            # map blocks listing the rewritten locations
+            blocks.extend(self._make_map_blocks(
+                locations, map_locations, min(first // self._map_entry_num, map_num - 1)))
+        data = bytes(self.block_size)
+        blocks.extend((data, d, b) for d, b in freed)
+        self._write_data_blocks(blocks)
+        for d, b in freed:
+            self._free_block(d, b)
+        # update the entry in place
+        if new_size == 0:
+            layout, (disk_idx, block_idx) = 'chain', (file_entry['file_disk'], file_entry['file_block'])
+        else:
+            disk_idx, block_idx = map_locations[0] if map_num > 0 else locations[0]
+        self._update_file_entry(file_entry, new_size, disk_idx, block_idx, layout)
+        return 0
+
+
+    # locations of the last data block and the last map block (None for the chain layout)
+    def _get_file_tail(self, file_entry):
+        file_name = file_entry['file_name']
+        if file_name not in self._file_tails:
+            map_locations, locations = self._get_file_locations(file_entry)
+            self._file_tails[file_name] = (locations[-1], map_locations[-1] if map_locations else None)
+        return self._file_tails[file_name]
+
+
+    # add data to the end of a file, only the tail blocks are written
+    @_synchronized
+    def append_file(self, file_name, b_data):
+        file_entry = self._get_file_entry(file_name)
+        if file_entry is None:
+            return -1  # no such file
+        if len(b_data) == 0:
+            return 0
+        file_size, layout = file_entry['file_size'], file_entry['file_layout']
+        new_size = file_size + len(b_data)
+        if self._used_blocks - self._file_blocks[file_name] + \
+                self._size_to_blocks(new_size, layout) > self._max_file_blocks:
+            return -1  # no enough spaces
+        if file_size == 0:
+            return self._splice_file(file_entry, 0, 0, b_data)  # no tail block yet
+        data_tail, map_tail = self._get_file_tail(file_entry)
+        # allocate the new data blocks and map blocks
+        data_extra = self._size_to_blocks(new_size) - self._size_to_blocks(file_size)
+        map_extra = self._size_to_blocks(new_size, layout) - self._size_to_blocks(file_size, layout) - data_extra
+        new_locations = self._next_available_blocks(data_extra + map_extra)
+        if new_locations is None:
+            return -1
+        for d, b in new_locations:
+            self._allocate_block(d, b)
+        locations, map_locations = new_locations[:data_extra], new_locations[data_extra:]
+        # fill the tail block
+        res, block = self._read_block(*data_tail)
+        size = self._block_get_size(block)
+        fill = min(self.block_data_size - size, len(b_data))
+        next_disk, next_block = locations[0] if locations else data_tail
+        block[0:4] = (size + fill).to_bytes(4, 'little')
+        block[4:8] = next_disk.to_bytes(4, 'little')
+        block[8:12] = next_block.to_bytes(4, 'little')
+        block[self.block_head_size+size:self.block_head_size+size+fill] = b_data[:fill]
+        blocks = [(block, data_tail[0], data_tail[1])]
+        # new data blocks
+        for i, (disk_idx, block_idx) in enumerate(locations):
+            chunk = b_data[fill+i*self.block_data_size:fill+(i+1)*self.block_data_size]
+            next_disk, next_block = locations[i + 1] if i + 1 < len(locations) else (disk_idx, block_idx)
+            block = bytearray()
+            block.extend(len(chunk).to_bytes(4, 'little'))
+            block.extend(next_disk.to_bytes(4, 'little'))
+            block.extend(next_block.to_bytes(4, 'little'))
+            block.extend(chunk)
+            block.extend(b'\x00' * (self.block_data_size - len(chunk)))
+            blocks.append((block, disk_idx, block_idx))
+        if layout == 'map' and locations:
+            # fill the last map block, the rest of the new locations go to new map blocks
+            res, block = self._read_block(*map_tail)
+            entry_num = self._block_get_size(block)
+            added = locations[:self._map_entry_num-entry_num]
+            next_disk, next_block = map_locations[0] if map_locations else map_tail
+            block[0:4] = (entry_num + len(added)).to_bytes(4, 'little')
+            block[4:8] = next_disk.to_bytes(4, 'little')
+            block[8:12] = next_block.to_bytes(4, 'little')
+            pos = self.block_head_size + entry_num * self._map_entry_size
+            for d, b in added:
+                block[pos:pos+4] = d.to_bytes(4, 'little')
+                block[pos+4:pos+8] = b.to_bytes(4, 'little')
+                pos += self._map_entry_size
+            blocks.append((block, map_tail[0], map_tail[1]))
+            blocks.extend(self._make_map_blocks(locations[len(added):], map_locations))
+        self._write_data_blocks(blocks)
+        self._update_file_entry(file_entry, new_size, file_entry['file_disk'], file_entry['file_block'], layout)
+        self._file_tails[file_name] = (locations[-1] if locations else data_tail,
+                                       map_locations[-1] if map_locations else map_tail)
+        return 0
+
+
+    # zero every block freed by lazy deletes now
+    @_synchronized
+    def reclaim(self):
+        self._reclaim_stripes()
+        return 0
+
+
+    # change the layout of a file, only the map blocks and the table entry are written
+    @_synchronized
+    def migrate_file(self, file_name, layout):
+        if layout not in ('chain', 'map'):
+            return -1
+        file_entry = self._get_file_entry(file_name)
+        if file_entry is None:
+            return -1  # no such file
+        if file_entry['file_layout'] == layout or file_entry['file_size'] == 0:
+            return 0
+        map_locations, locations = self._get_file_locations(file_entry)
+        if layout == 'map':
+            map_num = self._size_to_blocks(file_entry['file_size'], 'map') - len(locations)
+            if self._used_blocks + map_num > self._max_file_blocks:
+                return -1  # no enough spaces
+            map_locations = self._next_available_blocks(map_num)
+            if map_locations is None:
+                return -1
+            blocks = self._make_map_blocks(locations, map_locations)
+            for block, d, b in blocks:
+                self._allocate_block(d, b)
+            self._write_data_blocks(blocks)
+            disk_idx, block_idx = map_locations[0]
+        else:
+            disk_idx, block_idx = locations[0]
+        self._update_file_entry(file_entry, file_entry['file_size'], disk_idx, block_idx, layout)
+        if layout == 'chain':
+            # the data blocks are still chained, drop the map
+            data = bytes(self.block_size)
+            self._write_data_blocks([(data, d, b) for d, b in map_locations])
+            for d, b in map_locations:
+                self._free_block(d, b)
+        return 0
+
+
+    # change the layout of every file, new files are added with it too
+    @_synchronized
+    def migrate(self, layout):
+        if layout not in ('chain', 'map'):
+            return -1
+        for file_name in list(self._get_file_index()):
+            res = self.migrate_file(file_name, layout)
+            if res != 0:
+                return res
+        self.layout = layout
+        return 0
+
+
+    @_synchronized
     def list_files(self):
-        d, b = -1, 0
-        entries = []
-        # read file directory table
-        while d != self._last_table_disk or b != self._last_table_block :
-            d += 1
-            if d == self.disk_num:
-                d = 0
-                b += 1
-            if self._get_p_disk(b) == d or self._get_q_disk(b) == d:
-                continue
-            res, block = self._read_block(d, b)
-            offset = 0
-            while offset < self.block_size:
-                # change entry into dict
-                entry = self._entry_byte_to_dict(block[offset:offset+self._table_entry_size], d, b, offset)
-                if entry['file_name'] is not None:
-                    entries.append(entry)
-                offset += self._table_entry_size
-        return entries
+        entries = sorted(self._get_file_index().values(),
+                         key=lambda e: (e['entry_block'], e['entry_disk'], e['entry_offset']))
+        return [dict(e) for e in entries]
 
 
+    @_synchronized
     def reset_disk(self, disk_idx):
+        # the table may be wiped, load it again at the next use
+        self._file_index = None
+        self._free_entries = None
+        self._file_blocks = None
+        self._used_blocks = 0
+        self._file_tails = {}
+        self._file_versions = {}
+        self._block_bitmap = None
+        self._reclaim_pending = {}
+        if self._cache is not None:
+            self._cache.invalidate_disk(disk_idx)
         return self.disk_manager.reset_disk(disk_idx)
 
 
+    # space usage in data blocks, or the size and blocks of a single file
+    @_synchronized
+    def stat(self, file_name=None):
+        index = self._get_file_index()
+        if file_name is not None:
+            if file_name not in index:
+                return None
+            return {
+                'file_size': index[file_name]['file_size'],
+                'blocks': self._file_blocks[file_name],
+            }
+        return {
+            'block_size': self.block_size,
+            'block_data_size': self.block_data_size,
+            'total_blocks': self._max_file_blocks,
+            'used_blocks': self._used_blocks,
+            'free_blocks': self._max_file_blocks - self._used_blocks,
+            'files': len(index),
+            'free_entries': len(self._free_entries),
+            'reclaim_pending': sum(len(disks) for disks in self._reclaim_pending.values()),
+        }
+
+
+    # write the buffered blocks to the disks (write-back), 0 or -1 if a disk failed
+    @_synchronized
+    def flush(self):
+        return self.disk_manager.flush()
+
+
+    # flush and fsync every disk, written data is durable after it returns 0
+    @_synchronized
+    def sync(self):
+        return self.disk_manager.sync()
+
+
+    # probe the disks again, 0: healthy, -1: disk failures, -2: missing blocks
+    @_synchronized
+    def check_health(self):
+        return self.disk_manager.check_health()
+
+
+    # (rebuilt stripes, total stripes) of the last or running rebuild
+    def get_rebuild_progress(self):
+        with self._rebuild_progress_lock:
+            return tuple(self._rebuild_progress)
+
+
+    # hit / miss counters of the block cache, None without a cache
+    def get_cache_stats(self):
+        if self._cache is None:
+            return None
+        return self._cache.get_stats()
+
+
     def get_recovery_time(self):
         ret = self._recovery_time
         if ret is not None:
@@ -586,12 +1581,15 @@ class FileManager:
         return ret
 
 
+    @_synchronized
     def check_and_recover_corruption(self, block_idx):
+        # check what is on the disks, not what is buffered, only this stripe is flushed
+        self.disk_manager.flush_stripe(block_idx)
         # change data into the form of algorithm: [... p, q, ...] -> [...... p, q]
         block_stripe, pq_blocks = [], [None, None]
         p_idx, q_idx = self._get_p_disk(block_idx), self._get_q_disk(block_idx)
-        for d in range(self.disk_num):
-            res, block_data = self._read_block(d, block_idx, no_failure=True)
+        stripe = self._read_blocks([(d, block_idx) for d in range(self.disk_num)], no_failure=True)
+        for d, block_data in enumerate(stripe):
             if d == p_idx:
                 pq_blocks[0] = block_data
             elif d == q_idx:
@@ -599,39 +1597,26 @@ class FileManager:
             else:
                 block_stripe.append(block_data)
         block_stripe.extend(pq_blocks)
-        algo_disk, recover_entries, recover_block = -1, [], bytearray()
-        # check corruption
-        for i in range(self.block_size):
-            arr = [block_stripe[d][i] for d in range(self.disk_num)]
-            # check and fix
-            res_disk, res_data = corruption_check_fix(arr)
-            if res_disk < 0:
-                continue
-            if algo_disk == -1:
-                algo_disk = res_disk
-            elif algo_disk != res_disk:
-                raise Exception('More than 1 block corrupted in a stripe!')
-            recover_entries.append((i, res_data))  # [(offset, correct data), () ...]
+        # check corruption on the whole stripe
+        algo_disk, recover_block = corruption_check_fix_blocks(block_stripe)
         if algo_disk == -1:
-            return  # no corruption
+            return -1  # no corruption
         disk_idx = self._disk_algo_to_real(algo_disk, p_idx, q_idx)  # corrupted disk
-        res, corrupted_data = self._read_block(disk_idx, block_idx, no_failure=True)
-        # recover the corrupted offsets in a block
-        t = 0
-        for i in range(self.block_size):
-            if t >= len(recover_entries) or i < recover_entries[t][0]:
-                recover_block.append(corrupted_data[i])  # no corruption
-            else:
-                recover_block.append(recover_entries[t][1])  # corruption
-                t += 1
         self._write_block(recover_block, disk_idx, block_idx, no_failure=True)
+        return disk_idx
 
 
+    @_synchronized
     def fail_disk(self, disk_idx):
+        if self._cache is not None:
+            self._cache.invalidate_disk(disk_idx)
         return self.disk_manager.fail_disk(disk_idx)
 
 
+    @_synchronized
     def corrupt_block(self, disk_idx, block_idx):
+        if self._cache is not None:
+            self._cache.invalidate(disk_idx, block_idx)
         return self.disk_manager.corrupt_block(disk_idx, block_idx)
 
 
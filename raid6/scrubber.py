@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+
+
+class Scrubber:
+
+    """
+    walk every stripe of a FileManager, detect and fix corrupted blocks
+
+    stripe results:
+    'clean': no corruption
+    'repaired': a corrupted block was recovered
+    'failed': skipped, a disk or block of the stripe failed, it is left to the recovery
+    'unrecoverable': corruption the stripe can not be fixed from
+
+    only the stripes that are not clean are kept, clean ones are counted from the progress
+
+    checkpoint_format (json):
+    {"next_block": ..., "passes": ..., "results": {"block_idx": result, ...}}
+    """
+
+    def __init__(self,
+                 file_manager,
+                 rate=None,
+                 checkpoint_file=None,
+                 checkpoint_interval=64,
+                 continuous=False,
+                 ):
+        self.file_manager = file_manager
+        # bytes per second read by the scrubber, None for no limit
+        self.rate = rate
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        # start another pass after finishing all stripes
+        self.continuous = continuous
+        self._stripe_bytes = file_manager.disk_num * file_manager.block_size
+        # progress
+        self.next_block = 0
+        self.passes = 0
+        self.results = {}
+        self._load_checkpoint()
+        # background thread
+        self._thread = None
+        self._stop_event = threading.Event()
+
+
+    def _load_checkpoint(self):
+        if self.checkpoint_file is None or not os.path.isfile(self.checkpoint_file):
+            return
+        with open(self.checkpoint_file, 'r') as f:
+            state = json.load(f)
+        self.next_block = state['next_block']
+        self.passes = state['passes']
+        self.results = {int(b): r for b, r in state['results'].items() if r != 'clean'}
+        if self.next_block >= self.file_manager.block_num:
+            self.next_block = 0
+
+
+    def _save_checkpoint(self):
+        if self.checkpoint_file is None:
+            return
+        state = {
+            'next_block': self.next_block,
+            'passes': self.passes,
+            'results': {str(b): r for b, r in self.results.items()},
+        }
+        # write then rename, so a crash never leaves a broken checkpoint
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.checkpoint_file)
+
+
+    # check and recover a single stripe, return its result
+    def scrub_stripe(self, block_idx):
+        disk_manager = self.file_manager.disk_manager
+        if disk_manager.check_failure(block_idx) != 0:
+            result = 'failed'
+        else:
+            try:
+                res = self.file_manager.check_and_recover_corruption(block_idx)
+            except Exception:
+                # a disk may fail while checking
+                result = 'failed' if disk_manager.check_failure(block_idx) != 0 else 'unrecoverable'
+            else:
+                result = 'clean' if res == -1 else 'repaired'
+        if result == 'clean':
+            self.results.pop(block_idx, None)
+        else:
+            self.results[block_idx] = result
+        return result
+
+
+    # scrub stripes from the checkpoint to the end, return False if stopped before the end
+    def run_pass(self):
+        t0 = time.time()
+        scanned = 0
+        while self.next_block < self.file_manager.block_num:
+            if self._stop_event.is_set():
+                self._save_checkpoint()
+                return False
+            self.scrub_stripe(self.next_block)
+            self.next_block += 1
+            scanned += self._stripe_bytes
+            if self.next_block % self.checkpoint_interval == 0:
+                self._save_checkpoint()
+            # rate limit: wait until the bytes read fit in the budget
+            if self.rate is not None:
+                delay = t0 + scanned / self.rate - time.time()
+                if delay > 0 and self._stop_event.wait(delay):
+                    self._save_checkpoint()
+                    return False
+        self.next_block = 0
+        self.passes += 1
+        self._save_checkpoint()
+        return True
+
+
+    def _run(self):
+        while self.run_pass() and self.continuous:
+            pass
+
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return -1  # already running
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return 0
+
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+
+    # stripes of every result, only the number of clean ones
+    def get_report(self):
+        results = dict(self.results)
+        scanned = self.file_manager.block_num if self.passes > 0 else self.next_block
+        report = {
+            'next_block': self.next_block,
+            'passes': self.passes,
+            'clean': scanned - len(results),
+            'repaired': [],
+            'failed': [],
+            'unrecoverable': [],
+        }
+        for b, r in sorted(results.items()):
+            report[r].append(b)
+        return report
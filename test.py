@@ -1,9 +1,12 @@
+import asyncio
 import copy
+import json
 import logging
 import os
 import shutil
 import random
 import sys
+import threading
 import time
 import traceback
 import matplotlib.pyplot as plt
@@ -11,7 +14,12 @@ from matplotlib import ticker
 
 random.seed(0)
 
+from raid6 import fault_tolerance
+from raid6.Galoisfield256 import Galoisfield256
+from raid6.async_file_manager import AsyncFileManager
+from raid6.disk_manager import DiskManager
 from raid6.file_manager import FileManager
+from raid6.scrubber import Scrubber
 
 
 class Test:
@@ -749,11 +757,1139 @@ def test0():
         sys.exit()
 
 
+# scrub test
+def test_scrub():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 4 * 1024  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 6
+    myTest = Test(disk_size, block_size, max_file_num, disks)
+    myTest.reset()
+    file_manager = myTest.file_manager
+
+    with open('test_files/4.txt', 'rb') as f:
+        d0 = f.read()
+    file_manager.add_file('4.txt', d0)
+    corrupted = {2: 1, 5: 3, 9: 0}  # block_idx: disk_idx
+    for block_idx, disk_idx in corrupted.items():
+        file_manager.corrupt_block(disk_idx, block_idx)
+
+    scrubber = Scrubber(file_manager, rate=16 * 1024 * 1024)
+    scrubber.start()
+    scrubber.join()
+    report = scrubber.get_report()
+    if report['repaired'] != sorted(corrupted) or len(report['unrecoverable']) != 0:
+        print('--- scrub error ---')
+        print(report)
+        sys.exit()
+    if file_manager.read_file('4.txt') != d0:
+        print('--- scrub recovery error ---')
+        sys.exit()
+
+    # stopped by stop(), a new scrubber resumes from the checkpoint
+    checkpoint_file = './scrub_checkpoint.json'
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+    for block_idx, disk_idx in corrupted.items():
+        file_manager.corrupt_block(disk_idx, block_idx)
+    stripe_bytes = file_manager.disk_num * block_size
+    scrubber = Scrubber(file_manager, rate=10 * stripe_bytes, checkpoint_file=checkpoint_file, checkpoint_interval=2)
+    scrubber.start()
+    time.sleep(0.5)
+    scrubber.stop()
+    next_block = scrubber.next_block
+    if scrubber.is_running() or not 0 < next_block < file_manager.block_num:
+        print('--- scrub stop error ---')
+        print(next_block)
+        sys.exit()
+    scrubber = Scrubber(file_manager, rate=20 * stripe_bytes, checkpoint_file=checkpoint_file)
+    if scrubber.next_block != next_block:
+        print('--- scrub checkpoint error ---')
+        sys.exit()
+    t0 = time.time()
+    scrubber.run_pass()
+    # the rate limit: the rest of the stripes take at least this long
+    if time.time() - t0 < (file_manager.block_num - next_block - 1) / 20:
+        print('--- scrub rate error ---')
+        sys.exit()
+    report = scrubber.get_report()
+    if report['repaired'] != sorted(corrupted) or report['clean'] != file_manager.block_num - len(corrupted):
+        print('--- scrub resume error ---')
+        print(report)
+        sys.exit()
+    with open(checkpoint_file, 'r') as f:
+        if len(json.load(f)['results']) != len(corrupted):
+            print('--- scrub checkpoint error ---')
+            sys.exit()
+    os.remove(checkpoint_file)
+
+    # failed stripes are left to the recovery, not unrecoverable
+    file_manager.fail_disk(2)
+    scrubber = Scrubber(file_manager)
+    scrubber.run_pass()
+    report = scrubber.get_report()
+    if report['failed'] != list(range(file_manager.block_num)) or report['unrecoverable'] != []:
+        print('--- scrub failure error ---')
+        print(report)
+        sys.exit()
+
+
+# block map layout test, small blocks so that files need several map blocks
+def test_layout():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 256  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 8
+    myTest = Test(disk_size, block_size, max_file_num, disks)
+    myTest.reset()
+    file_manager = myTest.file_manager
+    file_manager.layout = 'map'
+
+    files = {}
+    for file_name in ['3.txt', '4.txt']:
+        with open(os.path.join('test_files', file_name), 'rb') as f:
+            files[file_name] = bytearray(f.read())
+        file_manager.add_file(file_name, files[file_name])
+    file_manager.add_file('chain.txt', files['3.txt'], 'chain')
+    files['chain.txt'] = bytearray(files['3.txt'])
+    # same size and resizing modifications
+    file_manager.modify_file('4.txt', 1000, 9000, b'x' * 8000)
+    files['4.txt'][1000:9000] = b'x' * 8000
+    file_manager.modify_file('3.txt', 10, 20, b'y' * 100)
+    files['3.txt'][10:20] = b'y' * 100
+    file_manager.fail_disk(2)
+    for layout in ['map', 'chain', 'map']:
+        if file_manager.migrate(layout) != 0:
+            print('--- migrate error ---')
+            sys.exit()
+        for file_name, data in files.items():
+            if file_manager.read_file(file_name) != data:
+                print('--- layout error ---')
+                print(layout, file_name)
+                sys.exit()
+    used = file_manager.stat()['used_blocks']
+    for file_name in files:
+        file_manager.del_file(file_name)
+    if file_manager.stat()['used_blocks'] != 0 or used == 0:
+        print('--- layout space error ---')
+        sys.exit()
+
+
+# ranged and streaming reads of both layouts
+def test_stream():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 256  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 8
+    myTest = Test(disk_size, block_size, max_file_num, disks)
+    myTest.reset()
+    file_manager = myTest.file_manager
+
+    with open('test_files/4.txt', 'rb') as f:
+        d0 = f.read()
+    file_manager.add_file('chain.txt', d0, 'chain')
+    file_manager.add_file('map.txt', d0, 'map')
+    for file_name in ['chain.txt', 'map.txt']:
+        if b''.join(file_manager.open_stream(file_name)) != d0:
+            print('--- stream error ---')
+            sys.exit()
+        for _ in range(20):
+            offset = random.randint(0, len(d0))
+            length = random.randint(0, 3000)
+            chunks = list(file_manager.read_range(file_name, offset, length))
+            if b''.join(chunks) != d0[offset:offset+length] or any(len(c) > block_size for c in chunks):
+                print('--- range error ---')
+                print(file_name, offset, length)
+                sys.exit()
+    if file_manager.read_range('none.txt', 0, 10) is not None:
+        print('--- range error ---')
+        sys.exit()
+    # a stream stops if its file is deleted, its blocks may belong to another file
+    for lazy_delete in [False, True]:
+        file_manager.lazy_delete = lazy_delete
+        for layout in ['chain', 'map']:
+            file_manager.add_file('a.txt', d0[:5000], layout)
+            stream = file_manager.open_stream('a.txt')
+            next(stream)
+            file_manager.del_file('a.txt')
+            file_manager.add_file('b.txt', b'B' * 3000, layout)
+            try:
+                for chunk in stream:
+                    pass
+                print('--- stream deleted error ---')
+                sys.exit()
+            except Exception:
+                pass
+            file_manager.del_file('b.txt')
+    file_manager.lazy_delete = False
+    file_manager.reclaim()
+    while file_manager._reclaim_thread is not None:
+        time.sleep(0.01)
+
+
+# streaming writes of both layouts
+def test_writer():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 256  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 8
+    myTest = Test(disk_size, block_size, max_file_num, disks)
+    myTest.reset()
+    file_manager = myTest.file_manager
+
+    with open('test_files/4.txt', 'rb') as f:
+        d0 = f.read()
+    for layout in ['chain', 'map']:
+        res, writer = file_manager.open_for_write(layout, len(d0), layout)
+        offset = 0
+        while offset < len(d0):
+            size = random.randint(1, 1000)
+            writer.write(d0[offset:offset+size])
+            offset += size
+        if file_manager.read_file(layout) is not None or writer.close() != 0:
+            print('--- writer error ---')
+            sys.exit()
+        if file_manager.read_file(layout) != d0:
+            print('--- writer data error ---')
+            print(layout)
+            sys.exit()
+    with open('test_files/4.txt', 'rb') as f:
+        file_manager.add_file('file.txt', f)
+    if file_manager.read_file('file.txt') != d0:
+        print('--- writer file object error ---')
+        sys.exit()
+    # a failing source aborts the writer, the name and the blocks are free again
+    used = file_manager.stat()['used_blocks']
+
+    def failing_chunks():
+        yield d0[:5000]
+        raise IOError('source failed')
+    try:
+        file_manager.add_file('failed.txt', failing_chunks())
+    except IOError:
+        pass
+    if file_manager.stat()['used_blocks'] != used or file_manager.add_file('failed.txt', d0[:10]) != 0:
+        print('--- writer source error ---')
+        sys.exit()
+    file_manager.del_file('failed.txt')
+    # writing more than the free space aborts and frees the blocks
+    res, writer = file_manager.open_for_write('big.txt')
+    while writer.write(d0) == 0:
+        pass
+    if writer.close() != -1 or file_manager.stat()['used_blocks'] != used:
+        print('--- writer abort error ---')
+        sys.exit()
+    if file_manager.add_file('more.txt', d0) != 0 or file_manager.read_file('more.txt') != d0:
+        print('--- writer abort error ---')
+        sys.exit()
+
+
+# size changing modifications of both layouts, edits at block boundaries included
+def test_splice():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 256  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 8
+    myTest = Test(disk_size, block_size, max_file_num, disks)
+    myTest.reset()
+    file_manager = myTest.file_manager
+    block_data_size = file_manager.block_data_size
+
+    with open('test_files/3.txt', 'rb') as f:
+        d0 = f.read()
+    for layout in ['chain', 'map']:
+        data = bytearray(d0)
+        file_manager.add_file(layout, data, layout)
+        edits = [(len(data), len(data), b'a' * 10),
+                 (block_data_size * 3, block_data_size * 3, b'b' * block_data_size * 40),
+                 (block_data_size * 2, None, b''),
+                 (0, 0, b'c' * 5),
+                 (1, None, b''),
+                 (0, None, b'd' * 3000)] + [None] * 20
+        for edit in edits:
+            if edit is None:
+                # random edit
+                begin = random.randint(0, len(data))
+                end = random.randint(begin, min(begin + 2000, len(data)))
+                b_data = b'e' * random.randint(0, 2000)
+            else:
+                begin, end, b_data = edit
+                if end is None:
+                    end = len(data)
+            if file_manager.modify_file(layout, begin, end, b_data) != 0:
+                print('--- splice error ---')
+                print(layout, begin, end, len(b_data))
+                sys.exit()
+            data[begin:end] = b_data
+            if file_manager.read_file(layout) != data or \
+                    file_manager.stat(layout)['file_size'] != len(data):
+                print('--- splice data error ---')
+                print(layout, begin, end, len(b_data))
+                sys.exit()
+        file_manager.del_file(layout)
+    if file_manager.stat()['used_blocks'] != 0:
+        print('--- splice space error ---')
+        sys.exit()
+
+
+# small appends of both layouts, crossing block and map block boundaries
+def test_append():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 256  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 8
+    myTest = Test(disk_size, block_size, max_file_num, disks)
+    myTest.reset()
+    file_manager = myTest.file_manager
+
+    for layout in ['chain', 'map']:
+        data = bytearray()
+        file_manager.add_file(layout, data, layout)
+        for i in range(400):
+            record = ('%d,%s\n' % (i, 'x' * random.randint(0, 100))).encode()
+            if file_manager.append_file(layout, record) != 0:
+                print('--- append error ---')
+                sys.exit()
+            data.extend(record)
+            if i % 50 == 0 and file_manager.read_file(layout) != data:
+                print('--- append data error ---')
+                print(layout, i)
+                sys.exit()
+        if file_manager.read_file(layout) != data or file_manager.stat(layout)['file_size'] != len(data):
+            print('--- append data error ---')
+            sys.exit()
+        file_manager.del_file(layout)
+    if file_manager.append_file('none.txt', b'x') != -1 or file_manager.stat()['used_blocks'] != 0:
+        print('--- append error ---')
+        sys.exit()
+
+
+# lazy delete, freed blocks are reused before or after they are zeroed
+def test_lazy_delete():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 256  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 8
+    myTest = Test(disk_size, block_size, max_file_num, disks)
+    myTest.reset()
+    file_manager = myTest.file_manager
+    file_manager.lazy_delete = True
+
+    with open('test_files/4.txt', 'rb') as f:
+        d0 = f.read()
+    for layout in ['chain', 'map']:
+        file_manager.add_file('a.txt', d0, layout)
+        file_manager.add_file('b.txt', d0[:10000], layout)
+        file_manager.del_file('a.txt')
+        file_manager.add_file('c.txt', d0[:20000], layout)  # reuses freed blocks
+        file_manager.del_file('b.txt')
+        file_manager.reclaim()
+        if file_manager.read_file('c.txt') != d0[:20000] or file_manager.stat()['reclaim_pending'] != 0:
+            print('--- lazy delete error ---')
+            sys.exit()
+        file_manager.del_file('c.txt', lazy=False)
+    # a disk fails while the reclaim is pending, the reclaimer leaves it to the recovery
+    file_manager.add_file('a.txt', d0)
+    file_manager.add_file('b.txt', d0[:10000])
+    with file_manager._lock:
+        file_manager.del_file('a.txt')
+        file_manager.fail_disk(3)
+    if file_manager.read_file('b.txt') != d0[:10000]:
+        print('--- lazy delete failure error ---')
+        sys.exit()
+    file_manager.add_file('c.txt', d0[:20000])  # recovers the disk
+    file_manager.reclaim()
+    if file_manager.read_file('b.txt') != d0[:10000] or file_manager.read_file('c.txt') != d0[:20000] \
+            or file_manager.stat()['reclaim_pending'] != 0:
+        print('--- lazy delete failure error ---')
+        sys.exit()
+    # an unexpected error ends the reclaimer, the blocks stay pending
+    reclaim_stripes = file_manager._reclaim_stripes
+    def failing_reclaim_stripes(*args, **kwargs):
+        raise ValueError('unexpected')
+    excepthook = threading.excepthook
+    threading.excepthook = lambda args: None
+    with file_manager._lock:
+        file_manager._reclaim_stripes = failing_reclaim_stripes
+        file_manager.del_file('c.txt')
+    while file_manager._reclaim_thread is not None:
+        time.sleep(0.01)
+    threading.excepthook = excepthook
+    file_manager._reclaim_stripes = reclaim_stripes
+    if file_manager.stat()['reclaim_pending'] == 0:
+        print('--- lazy delete error ---')
+        sys.exit()
+    file_manager.reclaim()
+    file_manager.del_file('b.txt', lazy=False)
+    # every file is deleted, data and parity are all zero again
+    for block_idx in range(file_manager.block_num):
+        for disk_idx in range(file_manager.disk_num):
+            if file_manager.disk_manager.read_block(disk_idx, block_idx)[1] != bytes(block_size):
+                print('--- lazy delete zero error ---')
+                print(disk_idx, block_idx)
+                sys.exit()
+
+
+# block cache, repeated reads hit memory and failures drop the cached blocks
+def test_cache():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 4 * 1024  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 6
+    file_manager = FileManager(disk_size, block_size, max_file_num, disks, cache_size=32 * block_size)
+    for d in range(len(disks)):
+        file_manager.reset_disk(d)
+
+    with open('test_files/3.txt', 'rb') as f:
+        d0 = f.read()
+    file_manager.add_file('3.txt', d0)
+    file_manager.read_file('3.txt')
+    stats = file_manager.get_cache_stats()
+    for _ in range(5):
+        file_manager.read_file('3.txt')
+    if file_manager.get_cache_stats()['misses'] != stats['misses']:
+        print('--- cache miss error ---')
+        print(file_manager.get_cache_stats())
+        sys.exit()
+    file_manager.corrupt_block(2, 1)
+    if file_manager.check_and_recover_corruption(1) != 2:
+        print('--- cache corruption error ---')
+        sys.exit()
+    file_manager.fail_disk(1)
+    if file_manager.read_file('3.txt') != d0:
+        print('--- cache data error ---')
+        sys.exit()
+    # wait for the background rebuild started by the degraded read
+    while file_manager.get_recovery_time() is None:
+        time.sleep(0.01)
+    if file_manager.read_file('3.txt') != d0:
+        print('--- cache data error ---')
+        sys.exit()
+    if file_manager.get_cache_stats()['blocks'] > 32:
+        print('--- cache size error ---')
+        sys.exit()
+
+
+# write-back buffering, nothing reaches the disks before a flush
+def test_write_back():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 4 * 1024  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 6
+    file_manager = FileManager(disk_size, block_size, max_file_num, disks, write_back_size=1024 * 1024)
+    for d in range(len(disks)):
+        file_manager.reset_disk(d)
+
+    with open('test_files/3.txt', 'rb') as f:
+        d0 = f.read()
+    file_manager.add_file('a.txt', d0)
+    # another manager of the same disks only sees what is flushed
+    if len(FileManager(disk_size, block_size, max_file_num, disks).list_files()) != 0:
+        print('--- write back error ---')
+        sys.exit()
+    if file_manager.read_file('a.txt') != d0 or file_manager.sync() != 0:
+        print('--- write back flush error ---')
+        sys.exit()
+    if FileManager(disk_size, block_size, max_file_num, disks).read_file('a.txt') != d0:
+        print('--- write back flush error ---')
+        sys.exit()
+    # buffered blocks of a failed disk are lost, and recovered from parity
+    file_manager.modify_file('a.txt', 0, 5000, b'x' * 5000)
+    file_manager.fail_disk(2)
+    file_manager.flush()
+    if FileManager(disk_size, block_size, max_file_num, disks).read_file('a.txt') != b'x' * 5000 + d0[5000:]:
+        print('--- write back failure error ---')
+        sys.exit()
+
+    # a corruption check only flushes its own stripe
+    file_manager.add_file('b.txt', d0)
+    dirty = set(file_manager.disk_manager._dirty)
+    if file_manager.check_and_recover_corruption(0) != -1 or \
+            set(file_manager.disk_manager._dirty) != {(d, b) for d, b in dirty if b != 0}:
+        print('--- write back stripe flush error ---')
+        sys.exit()
+    # a flush started by a full buffer reports a failed write
+    disk_manager = DiskManager(disk_size, block_size, disks, write_back_size=2 * block_size)
+    for d in range(len(disks)):
+        disk_manager.reset_disk(d)
+    disk_manager.write_block(b'x' * block_size, 1, 0)
+    shutil.rmtree('./disks/disk_1')
+    if disk_manager.write_block(b'x' * block_size, 0, 0) != -1:
+        print('--- write back flush result error ---')
+        sys.exit()
+
+
+# a random stripe of disk_num blocks, P & Q in the end
+def random_stripe(disk_num, size):
+    blocks = [os.urandom(size) for _ in range(disk_num - 2)]
+    return blocks + [bytes(b) for b in fault_tolerance.compute_PQ_blocks(blocks)]
+
+
+# P & Q of whole blocks, byte for byte the same as compute_PQ
+def test_PQ_blocks():
+    for _ in range(200):
+        disk_num = random.randint(3, 12)
+        size = random.choice([1, 7, 64, 4096])
+        stripe = random_stripe(disk_num, size)
+        for i in range(size):
+            column = [b[i] for b in stripe[:-2]] + [0, 0]
+            if fault_tolerance.compute_PQ(column) != [stripe[-2][i], stripe[-1][i]]:
+                print('--- PQ blocks error ---')
+                print(disk_num, size, i)
+                sys.exit()
+
+
+# block reconstruction of every one and two failure pattern, byte for byte the same as failure_fix
+def test_failure_fix_blocks():
+    for disk_num in range(3, 10):
+        size = 16
+        stripe = random_stripe(disk_num, size)
+        patterns = [[x] for x in range(disk_num)]
+        patterns += [[x, y] for x in range(disk_num) for y in range(x + 1, disk_num)]
+        for pos in patterns:
+            failed = [bytes(size) if i in pos else b for i, b in enumerate(stripe)]
+            fixed = fault_tolerance.failure_fix_blocks(failed, pos)
+            if [bytes(b) for b in fixed] != [stripe[i] for i in pos]:
+                print('--- failure fix blocks error ---')
+                print(disk_num, pos)
+                sys.exit()
+            for i in range(size):
+                column = [b[i] for b in failed]
+                if fault_tolerance.failure_fix(column, pos) != [b[i] for b in fixed]:
+                    print('--- failure fix blocks error ---')
+                    print(disk_num, pos, i)
+                    sys.exit()
+
+
+# parity updated from the delta of one data block, the same as computing it again for every position
+def test_update_PQ_blocks():
+    for disk_num in range(3, 12):
+        size = random.choice([1, 64, 4096])
+        stripe = random_stripe(disk_num, size)
+        for idx in range(disk_num - 2):
+            new = os.urandom(size)
+            P, Q = fault_tolerance.update_PQ_blocks(stripe[-2], stripe[-1], stripe[idx], new, idx)
+            data = stripe[:idx] + [new] + stripe[idx+1:-2]
+            if [P, Q] != fault_tolerance.compute_PQ_blocks(data):
+                print('--- update PQ blocks error ---')
+                print(disk_num, size, idx)
+                sys.exit()
+
+
+# array operations of GF(256) over every pair of elements, the same as the scalar ones
+def test_gf_arrays():
+    gf = Galoisfield256()
+    a = [x for x in range(256) for _ in range(256)]
+    b = list(range(256)) * 256
+    nonzero = list(range(1, 256))
+    if gf.multiply_array(a, b).tolist() != [gf.multiply(x, y) for x, y in zip(a, b)] \
+            or gf.div_array(a, [y or 1 for y in b]).tolist() != [gf.div(x, y or 1) for x, y in zip(a, b)] \
+            or gf.log_array(nonzero).tolist() != [gf.log(x) for x in nonzero] \
+            or gf.exp_array(range(510)).tolist() != [gf.exp(i) for i in range(510)]:
+        print('--- GF arrays error ---')
+        sys.exit()
+
+
+# corruption of one block of a stripe, the same position and bytes as corruption_check_fix
+def test_corruption_check_fix_blocks():
+    for _ in range(200):
+        disk_num = random.randint(3, 12)
+        size = 16
+        stripe = random_stripe(disk_num, size)
+        if fault_tolerance.corruption_check_fix_blocks(stripe) != [-1, None]:
+            print('--- corruption check blocks error ---')
+            sys.exit()
+        z = random.randrange(disk_num)
+        corrupted = list(stripe)
+        block = bytearray(stripe[z])
+        for i in random.sample(range(size), random.randint(1, size)):
+            block[i] ^= random.randint(1, 255)
+        corrupted[z] = bytes(block)
+        res = fault_tolerance.corruption_check_fix_blocks(corrupted)
+        if res[0] != z or bytes(res[1]) != stripe[z]:
+            print('--- corruption check blocks error ---')
+            print(disk_num, z)
+            sys.exit()
+        for i in range(size):
+            column = [b[i] for b in corrupted]
+            if corrupted[z][i] != stripe[z][i] and fault_tolerance.corruption_check_fix(column) != [z, stripe[z][i]]:
+                print('--- corruption check blocks error ---')
+                print(disk_num, z, i)
+                sys.exit()
+
+
+# cached exp table of GF(256), a damaged file is built again
+def test_gf_table():
+    table_file = './gf_exp_table.bin'
+    gf = Galoisfield256(table_file)
+    for damaged in [b'', bytes(255), bytes(range(1, 256)), gf.exp_table[:255].tobytes()[::-1]]:
+        with open(table_file, 'wb') as f:
+            f.write(damaged)
+        if Galoisfield256(table_file).exp_table.tolist() != gf.exp_table.tolist():
+            print('--- GF table error ---')
+            sys.exit()
+        with open(table_file, 'rb') as f:
+            if f.read() != gf.exp_table[:255].tobytes():
+                print('--- GF table file error ---')
+                sys.exit()
+    os.remove(table_file)
+    if gf.multi_dict is not gf.multi_dict or gf.power_dict is not gf.power_dict:
+        print('--- GF dict error ---')
+        sys.exit()
+
+
+# image disks, blocks are read and written through mmap
+def test_img():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 4 * 1024  # Bytes
+    max_file_num = 10
+    disks = [('img', './disks/')] * 6
+    file_manager = FileManager(disk_size, block_size, max_file_num, disks)
+    disk_manager = file_manager.disk_manager
+    for d in range(len(disks)):
+        file_manager.reset_disk(d)
+
+    with open('test_files/3.txt', 'rb') as f:
+        d0 = f.read()
+    with open('test_files/2.txt', 'rb') as f:
+        d1 = f.read()
+    file_manager.add_file('3.txt', d0)
+    d0 = d0[:100] + b'x' * 100 + d0[200:]
+    file_manager.modify_file('3.txt', 100, 200, b'x' * 100)
+    if file_manager.read_file('3.txt') != d0:
+        print('--- img data error ---')
+        sys.exit()
+    # views of the mmap, the same bytes as copies
+    for block_idx in range(file_manager.block_num):
+        for disk_idx in range(file_manager.disk_num):
+            res, view = disk_manager.read_block_view(disk_idx, block_idx)
+            if res != 0 or not isinstance(view, memoryview) or not view.readonly or \
+                    bytes(view) != disk_manager.read_block(disk_idx, block_idx)[1]:
+                print('--- img view error ---')
+                print(disk_idx, block_idx)
+                sys.exit()
+            view.release()
+
+    # a failed disk is recovered by the next write
+    file_manager.fail_disk(2)
+    if file_manager.read_file('3.txt') != d0:
+        print('--- img degraded read error ---')
+        sys.exit()
+    file_manager.add_file('2.txt', d1)
+    if file_manager.get_recovery_time() is None or not os.path.isfile(disk_manager._image_path(2)) or \
+            file_manager.read_file('3.txt') != d0 or file_manager.read_file('2.txt') != d1:
+        print('--- img recovery error ---')
+        sys.exit()
+
+    # an image removed outside the manager is not noticed while its mmap is open,
+    # reads still see the unlinked file, only a health check (or health_check_interval) finds it
+    os.remove(disk_manager._image_path(4))
+    if disk_manager.check_disk(4) != 0 or file_manager.read_file('3.txt') != d0:
+        print('--- img removed error ---')
+        sys.exit()
+    if file_manager.check_health() != -1:
+        print('--- img health error ---')
+        sys.exit()
+    file_manager.del_file('2.txt')
+    if file_manager.get_recovery_time() is None or file_manager.read_file('3.txt') != d0:
+        print('--- img recovery error ---')
+        sys.exit()
+
+    # reset every disk, nothing is left
+    for d in range(len(disks)):
+        file_manager.reset_disk(d)
+    if file_manager.list_files() != [] or file_manager.read_file('3.txt') is not None:
+        print('--- img reset error ---')
+        sys.exit()
+
+
+# disks removed outside the manager are found by health checks and recovered
+def test_health():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 4 * 1024  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 6
+    with open('test_files/3.txt', 'rb') as f:
+        d0 = f.read()
+    with open('test_files/2.txt', 'rb') as f:
+        d1 = f.read()
+    for health_check_interval in [None, 0]:
+        file_manager = FileManager(disk_size, block_size, max_file_num, disks,
+                                   health_check_interval=health_check_interval)
+        disk_manager = file_manager.disk_manager
+        for d in range(len(disks)):
+            file_manager.reset_disk(d)
+        file_manager.add_file('3.txt', d0)
+
+        # a disk folder and a block of another disk removed
+        shutil.rmtree('./disks/disk_1')
+        os.remove('./disks/disk_4/block_3')
+        if disk_manager.check_array() != 0:
+            print('--- health cached error ---')
+            sys.exit()
+        if health_check_interval is None and file_manager.check_health() != -1:
+            print('--- health check error ---')
+            sys.exit()
+        # the next write finds the failures (by the check above, or by the interval) and recovers
+        file_manager.add_file('2.txt', d1)
+        if file_manager.get_recovery_time() is None or disk_manager.check_array() != 0 or \
+                not os.path.isfile('./disks/disk_4/block_3') or len(os.listdir('./disks/disk_1')) != file_manager.block_num:
+            print('--- health recovery error ---')
+            sys.exit()
+        if file_manager.read_file('3.txt') != d0 or file_manager.read_file('2.txt') != d1:
+            print('--- health data error ---')
+            sys.exit()
+
+        # a block only missing, not a whole disk
+        os.remove('./disks/disk_0/block_0')
+        if file_manager.check_health() != -2:
+            print('--- health block error ---')
+            sys.exit()
+        file_manager.del_file('2.txt')
+        if file_manager.get_recovery_time() is None or disk_manager.check_array() != 0 or \
+                file_manager.read_file('3.txt') != d0:
+            print('--- health recovery error ---')
+            sys.exit()
+
+
+# batched reads and writes on the thread pool, every block has its own result
+def test_batch_io():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 1024  # Bytes
+    disks = [('f', './disks/')] * 6
+    if DiskManager(disk_size, block_size, disks).io_workers != min(len(disks), (os.cpu_count() or 1) * 4):
+        print('--- io workers error ---')
+        sys.exit()
+    disk_manager = DiskManager(disk_size, block_size, disks, io_workers=4)
+    for d in range(len(disks)):
+        disk_manager.reset_disk(d)
+
+    # results in the order of the requests
+    res = disk_manager._run_io(lambda i, d: time.sleep(random.random() * 0.01) or (i, d),
+                               [(i, i % len(disks)) for i in range(20)])
+    if res != [(i, i % len(disks)) for i in range(20)]:
+        print('--- run io error ---')
+        sys.exit()
+
+    blocks = [(os.urandom(block_size), d, b) for b in range(10) for d in range(len(disks))]
+    if disk_manager.write_blocks(blocks) != [0] * len(blocks):
+        print('--- batch write error ---')
+        sys.exit()
+    res = disk_manager.read_blocks([(d, b) for _, d, b in blocks])
+    if res != [(0, bytearray(block)) for block, _, _ in blocks]:
+        print('--- batch read error ---')
+        sys.exit()
+
+    # a missing block fails its own stripe only
+    os.remove('./disks/disk_3/block_5')
+    disk_manager.check_health()
+    res = disk_manager.write_blocks([(bytes(block_size), d, b) for b in [4, 5] for d in [0, 3]])
+    if res != [0, 0, -2, -2]:
+        print('--- batch partial write error ---')
+        print(res)
+        sys.exit()
+    # a failed disk and a missing block in the same batch
+    disk_manager.fail_disk(1)
+    res = disk_manager.read_blocks([(d, b) for _, d, b in blocks])
+    for (block, d, b), (r, data) in zip(blocks, res):
+        if d == 1:
+            expected = -1, None
+        elif d == 3 and b == 5:
+            expected = -2, None
+        elif b == 4 and d in [0, 3]:
+            expected = 0, bytearray(block_size)
+        else:
+            expected = 0, bytearray(block)
+        if (r, data) != expected:
+            print('--- batch partial read error ---')
+            print(d, b, r)
+            sys.exit()
+
+
+# file directory index, freed entry slots are reused in table order
+def test_file_index():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 256  # Bytes
+    max_file_num = 20
+    disks = [('f', './disks/')] * 6
+    file_manager = FileManager(disk_size, block_size, max_file_num, disks)
+    for d in range(len(disks)):
+        file_manager.reset_disk(d)
+
+    def slot(file_name):
+        entry = file_manager._get_file_entry(file_name)
+        return entry['entry_block'], entry['entry_disk'], entry['entry_offset']
+
+    names = ['{}.txt'.format(i) for i in range(12)]
+    for name in names:
+        file_manager.add_file(name, name.encode() * 10)
+    slots = [slot(name) for name in names]
+    if slots != sorted(slots) or len(set(slots)) != len(slots):
+        print('--- index slot order error ---')
+        sys.exit()
+    # free slots in a random order, they are taken again from the first one in the table
+    freed = random.sample(range(len(names)), 6)
+    for i in freed:
+        file_manager.del_file(names[i])
+    for j, i in enumerate(sorted(freed)):
+        file_manager.add_file('new_{}.txt'.format(j), b'new')
+        if slot('new_{}.txt'.format(j)) != slots[i]:
+            print('--- index slot reuse error ---')
+            print(j, i)
+            sys.exit()
+    # the index of a new FileManager on the same disks is the same
+    files = file_manager.list_files()
+    if FileManager(disk_size, block_size, max_file_num, disks).list_files() != files or \
+            any(file_manager._get_file_entry(f['file_name']) != f for f in files):
+        print('--- index reload error ---')
+        sys.exit()
+    for name in names:
+        data = file_manager.read_file(name)
+        if (data is None) != (names.index(name) in freed) or data not in [None, name.encode() * 10]:
+            print('--- index data error ---')
+            sys.exit()
+
+
+# free-block bitmap, a new FileManager on the same disks builds the same one
+def test_block_bitmap():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 256  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 6
+    file_manager = FileManager(disk_size, block_size, max_file_num, disks)
+    for d in range(len(disks)):
+        file_manager.reset_disk(d)
+
+    with open('test_files/4.txt', 'rb') as f:
+        d0 = f.read()
+    for i in range(30):
+        name = '{}.txt'.format(random.randint(0, 7))
+        if file_manager.read_file(name) is not None and random.random() < 0.4:
+            file_manager.del_file(name)
+        else:
+            file_manager.del_file(name)
+            begin = random.randint(0, len(d0) - 1)
+            file_manager.add_file(name, d0[begin:begin+random.randint(0, 20000)], random.choice(['chain', 'map']))
+        bitmap = bytes(file_manager._get_block_bitmap())
+        # every block of a file is in use
+        for entry in file_manager._get_file_index().values():
+            map_locations, locations = file_manager._get_file_locations(entry)
+            if any(bitmap[file_manager._block_pos(d, b)] != 1 for d, b in map_locations + locations):
+                print('--- bitmap used error ---')
+                sys.exit()
+        reloaded = FileManager(disk_size, block_size, max_file_num, disks)
+        if bytes(reloaded._get_block_bitmap()) != bitmap:
+            print('--- bitmap reload error ---')
+            print(i)
+            sys.exit()
+        for name in file_manager._get_file_index():
+            if reloaded.read_file(name) != file_manager.read_file(name):
+                print('--- bitmap data error ---')
+                sys.exit()
+
+
+# space accounting of stat() after every kind of change
+def test_stat():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 256  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 6
+    file_manager = FileManager(disk_size, block_size, max_file_num, disks)
+    for d in range(len(disks)):
+        file_manager.reset_disk(d)
+    block_data_size = file_manager.block_data_size
+    map_entry_num = block_data_size // 8
+
+    files = {}  # name -> (size, layout)
+    entries = file_manager.stat()['free_entries']  # whole table blocks, at least max_file_num
+
+    def check(step):
+        expected = {}
+        for name, (size, layout) in files.items():
+            blocks = -(-size // block_data_size)
+            if layout == 'map':
+                blocks += -(-blocks // map_entry_num)
+            expected[name] = blocks
+        stat = file_manager.stat()
+        if stat['used_blocks'] != sum(expected.values()) or stat['files'] != len(files) or \
+                stat['free_blocks'] != stat['total_blocks'] - stat['used_blocks'] or \
+                stat['free_entries'] != entries - len(files) or \
+                any(file_manager.stat(name) != {'file_size': files[name][0], 'blocks': blocks}
+                    for name, blocks in expected.items()):
+            print('--- stat error ---')
+            print(step, stat, expected)
+            sys.exit()
+
+    with open('test_files/4.txt', 'rb') as f:
+        d0 = f.read()
+    file_manager.add_file('a.txt', d0[:5000], 'chain')
+    files['a.txt'] = (5000, 'chain')
+    file_manager.add_file('b.txt', d0[:20000], 'map')
+    files['b.txt'] = (20000, 'map')
+    check('add')
+    file_manager.modify_file('a.txt', 100, 200, b'x' * 100)
+    check('modify')
+    file_manager.modify_file('a.txt', 100, 200, b'x' * 3000)
+    files['a.txt'] = (7900, 'chain')
+    check('modify size')
+    file_manager.modify_file('b.txt', 0, 15000, b'y')
+    files['b.txt'] = (5001, 'map')
+    check('modify size')
+    for _ in range(20):
+        file_manager.append_file('b.txt', b'z' * 300)
+        files['b.txt'] = (files['b.txt'][0] + 300, 'map')
+    check('append')
+    file_manager.del_file('a.txt', lazy=False)
+    del files['a.txt']
+    check('delete')
+    # freed blocks are free at once, zeroing them is pending
+    with file_manager._lock:
+        file_manager.del_file('b.txt', lazy=True)
+        del files['b.txt']
+        check('lazy delete')
+        if file_manager.stat()['reclaim_pending'] == 0:
+            print('--- stat reclaim error ---')
+            sys.exit()
+    file_manager.reclaim()
+    check('reclaim')
+    if file_manager.stat()['reclaim_pending'] != 0 or file_manager.stat('b.txt') is not None:
+        print('--- stat reclaim error ---')
+        sys.exit()
+
+
+# degraded reads and the background rebuild of a failed disk
+def test_background_rebuild():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 1024  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 6
+    file_manager = FileManager(disk_size, block_size, max_file_num, disks)
+    for d in range(len(disks)):
+        file_manager.reset_disk(d)
+
+    def wait_rebuild():
+        t0 = time.time()
+        while file_manager._rebuild_thread is not None:
+            if time.time() - t0 > 10:
+                print('--- rebuild thread error ---')
+                sys.exit()
+            time.sleep(0.01)
+
+    def check_stripes():
+        return all(file_manager.check_and_recover_corruption(b) == -1 for b in range(file_manager.block_num))
+
+    with open('test_files/4.txt', 'rb') as f:
+        d0 = f.read()
+    with open('test_files/3.txt', 'rb') as f:
+        d1 = f.read()
+    file_manager.add_file('4.txt', d0)
+    # the background rebuild can not run while the lock is held
+    with file_manager._lock:
+        file_manager.fail_disk(2)
+        if file_manager.read_file('4.txt') != d0 or not file_manager._degraded or \
+                file_manager.disk_manager.check_disk(2) == 0:
+            print('--- degraded read error ---')
+            sys.exit()
+    wait_rebuild()
+    if file_manager._degraded or file_manager.disk_manager.check_array() != 0 or \
+            file_manager.get_recovery_time() is None or not check_stripes():
+        print('--- background rebuild error ---')
+        sys.exit()
+
+    # a write while the rebuild is pending
+    with file_manager._lock:
+        file_manager.fail_disk(4)
+        file_manager.read_file('4.txt')
+    file_manager.add_file('3.txt', d1)
+    wait_rebuild()
+    if file_manager.read_file('4.txt') != d0 or file_manager.read_file('3.txt') != d1 or \
+            file_manager.disk_manager.check_array() != 0 or not check_stripes():
+        print('--- rebuild write error ---')
+        sys.exit()
+
+    # a failed batch ends the thread, the next write recovers
+    rebuild_stripes = file_manager._rebuild_stripes
+    def failing_rebuild_stripes(*args, **kwargs):
+        raise Exception('Failure in more than 2 disks of a stripe!')
+    excepthook = threading.excepthook
+    threading.excepthook = lambda args: None
+    with file_manager._lock:
+        file_manager.fail_disk(1)
+        file_manager._rebuild_stripes = failing_rebuild_stripes
+        file_manager.read_file('4.txt')
+    wait_rebuild()
+    threading.excepthook = excepthook
+    file_manager._rebuild_stripes = rebuild_stripes
+    if not file_manager._degraded:
+        print('--- rebuild failure error ---')
+        sys.exit()
+    file_manager.del_file('3.txt')
+    if file_manager._degraded or file_manager.read_file('4.txt') != d0 or not check_stripes():
+        print('--- rebuild failure error ---')
+        sys.exit()
+
+
+# rebuild of failed disks by one or several workers, byte for byte the same blocks
+def test_rebuild_workers():
+    disk_size = 64 * 1024  # Bytes
+    block_size = 1024  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 6
+    with open('test_files/4.txt', 'rb') as f:
+        d0 = f.read()
+    for rebuild_workers in [1, 4]:
+        file_manager = FileManager(disk_size, block_size, max_file_num, disks, rebuild_workers=rebuild_workers)
+        disk_manager = file_manager.disk_manager
+        for d in range(len(disks)):
+            file_manager.reset_disk(d)
+        file_manager.add_file('4.txt', d0)
+        blocks = [[disk_manager.read_block(d, b)[1] for b in range(file_manager.block_num)]
+                  for d in range(len(disks))]
+        for failed in [[3], [0, 5]]:
+            for d in failed:
+                file_manager.fail_disk(d)
+            with file_manager._lock:
+                file_manager._recover_from_failure(0)
+            if file_manager.get_rebuild_progress() != (file_manager.block_num, file_manager.block_num):
+                print('--- rebuild progress error ---')
+                print(rebuild_workers, failed, file_manager.get_rebuild_progress())
+                sys.exit()
+            if [[disk_manager.read_block(d, b)[1] for b in range(file_manager.block_num)]
+                    for d in range(len(disks))] != blocks or file_manager.read_file('4.txt') != d0:
+                print('--- rebuild workers error ---')
+                print(rebuild_workers, failed)
+                sys.exit()
+
+
+# asyncio front end test
+def test_async():
+    disk_size = 256 * 1024  # Bytes
+    block_size = 4 * 1024  # Bytes
+    max_file_num = 10
+    disks = [('f', './disks/')] * 8
+    myTest = Test(disk_size, block_size, max_file_num, disks)
+    myTest.reset()
+    file_manager = myTest.file_manager
+
+    files = {}
+    for file_name in ['2.txt', '3.txt', '4.txt', '5.txt']:
+        with open(os.path.join('test_files', file_name), 'rb') as f:
+            files[file_name] = f.read()
+
+    async def run():
+        async with AsyncFileManager(file_manager) as async_manager:
+            res = await asyncio.gather(*[async_manager.add_file(n, d) for n, d in files.items()])
+            if any(r != 0 for r in res):
+                return 'add'
+            # a slow disk only holds up its own queue
+            read_block = file_manager.disk_manager.read_block
+            def slow_read_block(disk_idx, block_idx, buffer=None):
+                if disk_idx == 0:
+                    time.sleep(0.5)
+                return read_block(disk_idx, block_idx, buffer)
+            file_manager.disk_manager.read_block = slow_read_block
+            slow = asyncio.ensure_future(async_manager._read_block(0, 0))
+            await asyncio.sleep(0.05)
+            t0 = time.time()
+            await async_manager._read_block(2, 0)
+            if time.time() - t0 > 0.25:
+                return 'slow disk'
+            await slow
+            file_manager.disk_manager.read_block = read_block
+            file_manager.fail_disk(3)
+            res = await asyncio.gather(*[async_manager.read_file(n) for n in files])
+            if res != list(files.values()):
+                return 'read'
+            res = await asyncio.gather(async_manager.del_file('2.txt'), async_manager.read_file('3.txt'))
+            if res[0] != 0 or res[1] != files['3.txt']:
+                return 'delete'
+            if sorted(e['file_name'] for e in await async_manager.list_files()) != ['3.txt', '4.txt', '5.txt']:
+                return 'ls'
+        return None
+
+    err = asyncio.run(run())
+    if err is not None:
+        print(f'--- async {err} error ---')
+        sys.exit()
+
+
 if __name__ == '__main__':
     pass
     # extreme test
     # test0()
 
+    # scrub test
+    # test_scrub()
+
+    # asyncio test
+    # test_async()
+
+    # block map layout test
+    # test_layout()
+
+    # ranged and streaming reads test
+    # test_stream()
+
+    # streaming writes test
+    # test_writer()
+
+    # size changing modifications test
+    # test_splice()
+
+    # append test
+    # test_append()
+
+    # lazy delete test
+    # test_lazy_delete()
+
+    # block cache test
+    # test_cache()
+
+    # write-back test
+    # test_write_back()
+
+    # image disks test
+    # test_img()
+
+    # health check test
+    # test_health()
+
+    # batched I/O test
+    # test_batch_io()
+
+    # block parity test
+    # test_PQ_blocks()
+
+    # block reconstruction test
+    # test_failure_fix_blocks()
+
+    # parity update test
+    # test_update_PQ_blocks()
+
+    # GF(256) table test
+    # test_gf_table()
+
+    # GF(256) arrays test
+    # test_gf_arrays()
+
+    # corruption check test
+    # test_corruption_check_fix_blocks()
+
+    # file directory index test
+    # test_file_index()
+
+    # free-block bitmap test
+    # test_block_bitmap()
+
+    # space accounting test
+    # test_stat()
+
+    # rebuild workers test
+    # test_rebuild_workers()
+
+    # background rebuild test
+    # test_background_rebuild()
+
     # random test
     random_test()
 